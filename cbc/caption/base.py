@@ -14,6 +14,13 @@ class CaptionEngine(ABC):
         # Takes an RGB image and returns a list of captions
         raise NotImplementedError()
 
+    def batch(
+        self, raw_images: List[Image], n_captions: int = 1, temperature: Optional[float] = None
+    ) -> List[List[str]]:
+        # Takes a list of RGB images and returns a list of captions for each image. Engines which can run a single
+        # batched generation call should override this, the default falls back to captioning each image in turn.
+        return [self(raw_image, n_captions=n_captions, temperature=temperature) for raw_image in raw_images]
+
     @abstractmethod
     def get_baseline_caption(self, raw_image: Image) -> str:
         raise NotImplementedError()
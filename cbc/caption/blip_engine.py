@@ -1,4 +1,4 @@
-from typing import Dict, List, Literal, Optional, Union
+from typing import Callable, Dict, List, Literal, Optional, Union
 
 import torch
 import transformers
@@ -163,7 +163,6 @@ def _generate_t5_with_temperature(
     num_captions: int = 1,
     temperature: float = 1.0,
 ) -> List[str]:
-
     image = samples["image"]
 
     # Specify32 instead of bfloat16, since bfloat16 is not supported by a lot of GPUs
@@ -224,23 +223,43 @@ class BLIPCaptionEngine(CaptionEngine):
         self._device = device
 
     def __call__(self, raw_image: Image, n_captions: int = 1, temperature: Optional[float] = 1.0) -> List[str]:
-        image = self._vis_processors["eval"](raw_image).unsqueeze(0).to(self._device)  # type: ignore
+        return self.batch([raw_image], n_captions=n_captions, temperature=temperature)[0]
+
+    def batch(
+        self, raw_images: List[Image], n_captions: int = 1, temperature: Optional[float] = 1.0
+    ) -> List[List[str]]:
+        images = torch.stack([self._vis_processors["eval"](raw_image) for raw_image in raw_images]).to(  # type: ignore
+            self._device
+        )
+
+        # Generate the best beam search caption for each image. The prompt is repeated for each of the beams, so there
+        # are num_beams (identical) rows for each image, and we only keep the first.
+        num_beams = 16
+        baseline_captions = _generate_with_temperature(
+            self._model,
+            {"image": images},
+            num_captions=1,
+            top_p=0.9,
+            use_nucleus_sampling=False,
+            num_beams=num_beams,
+        )
+        output_captions = [[caption] for caption in baseline_captions[::num_beams]]
 
-        output_captions = [self.get_baseline_caption(raw_image)]
         if n_captions > 1:
             n_captions -= 1  # We'll always add the baseline caption
-            # Generate sampled captions
+            # Generate sampled captions, which are returned grouped by image
             output_generated = _generate_with_temperature(
                 self._model,
-                {"image": image},
+                {"image": images},
                 num_captions=n_captions,
                 use_nucleus_sampling=True,
                 top_p=0.9,
                 temperature=temperature or 1.0,
             )
-            output_captions += output_generated
+            for i, captions in enumerate(output_captions):
+                captions += output_generated[i * n_captions : (i + 1) * n_captions]
 
-        return [postprocess_caption(cap) for cap in output_captions]
+        return [[postprocess_caption(cap) for cap in captions] for captions in output_captions]
 
     def get_baseline_caption(self, raw_image: Image) -> str:
         # Generate best beam search caption
@@ -271,50 +290,55 @@ class BLIP2CaptionEngine(CaptionEngine):
         self._device = device
         self._architecture = architecture
 
+    def _get_generate_fn(self) -> Callable[..., List[str]]:
+        if self._architecture == "blip2_opt":
+            return _generate_opt_with_temperature
+        elif self._architecture == "blip2_t5":
+            return _generate_t5_with_temperature
+        raise ValueError(f"Architecture {self._architecture} not supported for BLIP2CaptionEngine.")
+
     def __call__(self, raw_image: Image, n_captions: int = 1, temperature: Optional[float] = 1.0) -> List[str]:
-        image = self._vis_processors["eval"](raw_image).unsqueeze(0).to(self._device)  # type: ignore
+        return self.batch([raw_image], n_captions=n_captions, temperature=temperature)[0]
+
+    def batch(
+        self, raw_images: List[Image], n_captions: int = 1, temperature: Optional[float] = 1.0
+    ) -> List[List[str]]:
+        _gen_fn = self._get_generate_fn()
+        images = torch.stack([self._vis_processors["eval"](raw_image) for raw_image in raw_images]).to(  # type: ignore
+            self._device
+        )
+
+        # Generate the best beam search caption for each image
+        baseline_captions = _gen_fn(
+            self._model,
+            {"image": images},
+            num_captions=1,
+            top_p=0.9,
+            use_nucleus_sampling=False,
+            num_beams=16,
+        )
+        output_captions = [[caption] for caption in baseline_captions]
 
-        output_captions = [self.get_baseline_caption(raw_image)]
         if n_captions > 1:
             n_captions -= 1  # We'll always add the baseline caption
-            # Generate sampled captions
-            if self._architecture == "blip2_opt":
-                output_generated = _generate_opt_with_temperature(
-                    self._model,
-                    {"image": image},
-                    num_captions=n_captions,
-                    use_nucleus_sampling=True,
-                    top_p=0.9,
-                    temperature=temperature or 1.0,
-                )
-            elif self._architecture == "blip2_t5":
-                output_generated = _generate_t5_with_temperature(
-                    self._model,
-                    {"image": image},
-                    num_captions=n_captions,
-                    use_nucleus_sampling=True,
-                    top_p=0.9,
-                    temperature=temperature or 1.0,
-                )
-            else:
-                raise ValueError(f"Architecture {self._architecture} not supported for BLIP2CaptionEngine.")
-
-            output_captions += output_generated
+            # Generate sampled captions, which are returned grouped by image
+            output_generated = _gen_fn(
+                self._model,
+                {"image": images},
+                num_captions=n_captions,
+                use_nucleus_sampling=True,
+                top_p=0.9,
+                temperature=temperature or 1.0,
+            )
+            for i, captions in enumerate(output_captions):
+                captions += output_generated[i * n_captions : (i + 1) * n_captions]
 
-        return [postprocess_caption(cap) for cap in output_captions]
+        return [[postprocess_caption(cap) for cap in captions] for captions in output_captions]
 
     def get_baseline_caption(self, raw_image: Image) -> str:
         # Generate best beam search caption
         image = self._vis_processors["eval"](raw_image).unsqueeze(0).to(self._device)  # type: ignore
-        _gen_fn = (
-            _generate_opt_with_temperature
-            if self._architecture == "blip2_opt"
-            else _generate_t5_with_temperature
-            if self._architecture == "blip2_t5"
-            else None
-        )
-        if _gen_fn is None:
-            raise ValueError(f"Architecture {self._architecture} not supported for BLIP2CaptionEngine.")
+        _gen_fn = self._get_generate_fn()
         beam_search_caption = _gen_fn(
             self._model,
             {"image": image},
@@ -65,7 +65,6 @@ class OFACaptionEngine(CaptionEngine):
     def __init__(
         self, ofa_model: str = "large-caption", device: Optional[str] = None, prompt: str = _OFA_DEFAULT_PROMPT
     ):
-
         tokenizer_path, model_path = _get_ofa_model(ofa_model)
         self.tokenizer = OFATokenizer.from_pretrained(tokenizer_path)
         self.model = OFAModel.from_pretrained(model_path, device=device, use_cache=True)
@@ -92,27 +91,43 @@ class OFACaptionEngine(CaptionEngine):
         return self.tokenizer([self.prompt], return_tensors="pt").input_ids.to(self.device)
 
     def __call__(self, raw_image: Image.Image, n_captions: int = 1, temperature: Optional[float] = 1.0) -> List[str]:
+        return self.batch([raw_image], n_captions=n_captions, temperature=temperature)[0]
+
+    def batch(
+        self, raw_images: List[Image.Image], n_captions: int = 1, temperature: Optional[float] = 1.0
+    ) -> List[List[str]]:
+        patch_imgs = torch.cat([self._preprocess_image(raw_image) for raw_image in raw_images], dim=0)
+        inputs = self._get_language_prompt().repeat(len(raw_images), 1)
 
-        patch_img = self._preprocess_image(raw_image)
-        inputs = self._get_language_prompt()
+        # Generate the best beam search caption for each image
+        baseline_gen = self.model.generate(  # type: ignore
+            inputs,
+            patch_images=patch_imgs,
+            num_beams=16,
+            no_repeat_ngram_size=3,
+            max_length=256,
+        )
+        output_captions = [[caption] for caption in self.tokenizer.batch_decode(baseline_gen, skip_special_tokens=True)]
 
-        output_captions = [self.get_baseline_caption(raw_image)]
         if n_captions > 1:
-            for _ in range(n_captions - 1):
-                # Sample from the model
-                gen = self.model.generate(  # type: ignore
-                    inputs,
-                    patch_images=patch_img,
-                    do_sample=True,
-                    top_p=0.9,
-                    temperature=temperature,
-                    no_repeat_ngram_size=3,
-                    max_length=256,
-                    num_beams=1,
-                )
-                output_captions.append(self.tokenizer.batch_decode(gen, skip_special_tokens=True)[0])
-
-        return [postprocess_caption(caption.strip()) for caption in output_captions]
+            n_captions -= 1  # We'll always add the baseline caption
+            # Sample from the model, the sequences are returned grouped by image
+            gen = self.model.generate(  # type: ignore
+                inputs,
+                patch_images=patch_imgs,
+                do_sample=True,
+                top_p=0.9,
+                temperature=temperature,
+                no_repeat_ngram_size=3,
+                max_length=256,
+                num_beams=1,
+                num_return_sequences=n_captions,
+            )
+            output_generated = self.tokenizer.batch_decode(gen, skip_special_tokens=True)
+            for i, captions in enumerate(output_captions):
+                captions += output_generated[i * n_captions : (i + 1) * n_captions]
+
+        return [[postprocess_caption(caption.strip()) for caption in captions] for captions in output_captions]
 
     def get_baseline_caption(self, raw_image: Image.Image) -> str:
         patch_image = self._preprocess_image(raw_image)
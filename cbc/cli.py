@@ -3,6 +3,7 @@ import click
 from .caption_by_committee import caption
 from .dataset import evaluate_dataset
 from .plugins.test import test_plugin
+from .prepack import prepack_images
 
 
 @click.group()
@@ -13,3 +14,4 @@ def main() -> None:
 main.add_command(evaluate_dataset)
 main.add_command(caption)
 main.add_command(test_plugin)
+main.add_command(prepack_images)
@@ -1,17 +1,27 @@
+import gc
+import glob
+import itertools
 import json
 import os
-from typing import Any, Dict, List, Optional
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import reduce
+from operator import getitem, itemgetter
+from typing import Any, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
 
 import click
 import numpy as np
+import orjson
 import torch
 import tqdm
 from PIL import Image
+from torch.utils.data import DataLoader, Dataset
 
 from cbc.caption import CAPTION_ENGINES_CLI
 from cbc.caption.ic3.caption_by_committee import DEFAULT_CBC_PROMPT, get_prompt_for_candidates
 from cbc.caption.utils import postprocess_caption
-from cbc.lm import LM_ENGINES_CLI, LM_LOCAL_ENGINES
+from cbc.lm import LM_ENGINES_CLI, LM_LOCAL_ENGINES, LMEngine, VLLMLlamaLMEngine
+from cbc.lm.huggingface_llama_engine import HuggingFaceLlamaLMEngine
 from cbc.metrics import (
     compute_and_add_base_metrics,
     compute_and_add_clip_recall,
@@ -19,8 +29,42 @@ from cbc.metrics import (
     compute_and_add_mauve_score,
     compute_and_add_object_hallucinations,
     compute_and_add_self_bleu,
+    load_image_feature_cache,
+    release_clip_model,
+    save_image_feature_cache,
 )
 from cbc.plugins import IMAGE_PLUGINS
+from cbc.utils.images import PackedImages
+
+
+# Allow numpy values (e.g. scores which were not cast to python floats) to be written out
+_ORJSON_OPTIONS = orjson.OPT_SERIALIZE_NUMPY
+
+_SUMMARY_KEYS = ("candidate_summary", "reference_summary", "baseline")
+_BASE_METRIC_KEYS = [
+    f"{k}_{m}" for k in _SUMMARY_KEYS for m in ("bleu_1", "bleu_2", "bleu_3", "bleu_4", "rouge", "cider")
+]
+_MAUVE_METRIC_KEYS = [f"{k}_mauve" for k in _SUMMARY_KEYS]
+_CLIP_RECALL_METRIC_KEYS = [
+    f"{k}_clip_recall_{m}" for k in _SUMMARY_KEYS for m in ("rank", "mrr", "at_1", "at_5", "at_10", "max_rank")
+]
+_CONTENT_RECALL_METRIC_KEYS = [
+    f"{k}_{m}" for k in _SUMMARY_KEYS for m in ("noun_recall", "verb_recall", "noun_fuzzy_recall", "verb_fuzzy_recall")
+]
+
+# (output group, path to the nested dict within the scores, score keys, output keys) for each of the aggregated metrics
+_METRIC_SCHEMA: List[Tuple[str, Tuple[str, ...], List[str], List[str]]] = [
+    # Base Scores + Mauve Scores
+    ("standard", (), _BASE_METRIC_KEYS + _MAUVE_METRIC_KEYS, _BASE_METRIC_KEYS + _MAUVE_METRIC_KEYS),
+    # Self-BLEU
+    ("standard", ("self_bleu",), ["candidates", "references"], ["candidate_self_bleu", "reference_self_bleu"]),
+    # CLIP Scores
+    ("clip_recall", (), _CLIP_RECALL_METRIC_KEYS, _CLIP_RECALL_METRIC_KEYS),
+    # Content Scores
+    ("content_recall", ("content_recall",), _CONTENT_RECALL_METRIC_KEYS, _CONTENT_RECALL_METRIC_KEYS),
+    # Hallucination Scores
+    ("hallucinations", (), ["hungarian_matching_score"], ["average_hungarian_matching_score"]),
+]
 
 
 @click.command()
@@ -37,6 +81,17 @@ from cbc.plugins import IMAGE_PLUGINS
     default="gpt3_davinci3",
     help="The LM to use.",
 )
+@click.option(
+    "--lm-precision",
+    type=click.Choice(["fp32", "fp16", "bf16", "int8", "int4"]),
+    default="fp16",
+    help="Precision to load local Llama-family LMs with (int8/int4 need bitsandbytes and are not supported by vLLM).",
+)
+@click.option(
+    "--lm-compile",
+    is_flag=True,
+    help="Whether to compile local Llama-family LMs with torch.compile (the model is warmed up once when loaded).",
+)
 @click.option(
     "--plugin",
     "-p",
@@ -47,6 +102,25 @@ from cbc.plugins import IMAGE_PLUGINS
 )
 @click.option("--num-candidates", type=int, default=15, help="Number of candidates to generate for each image.")
 @click.option("--candidate-temperature", type=float, default=1.0, help="Temperature to use when generating candidates.")
+@click.option("--gpu-batch-size", type=int, default=8, help="Number of images to caption in a single batch on the GPU.")
+@click.option(
+    "--plugin-batch-size", type=int, default=16, help="Number of images to pass to each plugin in a single batch."
+)
+@click.option(
+    "--llm-batch-size", type=int, default=8, help="Number of summary prompts to pass to the LM in a single batch."
+)
+@click.option(
+    "--summary-max-new-tokens",
+    type=int,
+    default=48,
+    help="Maximum number of tokens to generate for each summary (for local LMs).",
+)
+@click.option(
+    "--summary-beams",
+    type=int,
+    default=1,
+    help="Number of beams to use when generating summaries (for local LMs, vLLM engines only support 1).",
+)
 @click.option(
     "--prompt",
     type=str,
@@ -58,6 +132,30 @@ from cbc.plugins import IMAGE_PLUGINS
 @click.option("--reference-key", type=str, default="references", help="The key to use for the references.")
 @click.option("--image-path-key", type=str, default="image_path", help="The key to use for the image path.")
 @click.option("--image-root-dir", type=str, default=None, help="The root directory for the images.")
+@click.option(
+    "--num-metric-workers",
+    type=int,
+    default=1,
+    help="Number of processes to use for the CPU-bound (Self-BLEU, Content recall) metrics. Each process loads its own"
+    " copy of the spaCy en_core_web_lg model (~1GB), so keep this small.",
+)
+@click.option(
+    "--packed-images",
+    type=str,
+    default=None,
+    help="Prefix of images packed with prepack-images. Packed images are read without decoding.",
+)
+@click.option(
+    "--num-gpus",
+    type=int,
+    default=1,
+    help="Number of GPUs to shard the candidate and summary generation across (one worker process per GPU).",
+)
+@click.option(
+    "--clip-fp16",
+    is_flag=True,
+    help="Whether to run the CLIP recall encoders in half precision (faster, but the ranks can differ slightly).",
+)
 @click.option("--overwrite-candidates", is_flag=True, help="Whether to overwrite the candidates if they already exist.")
 @click.option(
     "--overwrite-candidate-summaries",
@@ -68,273 +166,510 @@ def evaluate_dataset(
     dataset_json_path: str,
     caption_engine: str,
     lm_engine: str,
+    lm_precision: str,
+    lm_compile: bool,
     plugin: List[str],
     num_candidates: int,
     candidate_temperature: float,
+    gpu_batch_size: int,
+    plugin_batch_size: int,
+    llm_batch_size: int,
+    summary_max_new_tokens: int,
+    summary_beams: int,
     prompt: str,
     output_json_path: str,
     candidate_key: str,
     reference_key: str,
     image_path_key: str,
     image_root_dir: Optional[str] = None,
+    packed_images: Optional[str] = None,
+    num_metric_workers: int = 1,
+    num_gpus: int = 1,
+    clip_fp16: bool = False,
     overwrite_candidates: bool = False,
     overwrite_candidate_summaries: bool = False,
 ) -> None:
     # 1. Load the dataset (references + image paths)
     print(f"Loading dataset from {dataset_json_path}...")
-    with open(dataset_json_path) as f:
-        samples: List[Dict[str, Any]] = json.load(f)
+    with open(dataset_json_path, "rb") as f:
+        samples: List[Dict[str, Any]] = orjson.loads(f.read())
         if isinstance(samples, dict):
             samples = samples["samples"]  # type: ignore
 
-    # 1.1 Load the prompt (if not already loaded)
+    # 1.1 Resume from the checkpoint of a previous (crashed) run, if there is one
+    checkpoint_path = f"{output_json_path}.tmp.jsonl"
+    checkpoint_header = _get_checkpoint_header(dataset_json_path, samples)
+    if os.path.exists(checkpoint_path):
+        print(f"Resuming from checkpoint {checkpoint_path}...")
+        _load_jsonl(checkpoint_path, checkpoint_header, samples)
+    # Including the per-GPU checkpoints of a multi-GPU run
+    _merge_shard_checkpoints(checkpoint_path, checkpoint_header, samples)
+
+    # 1.2 Load the prompt (if not already loaded)
     if os.path.exists(prompt):
         print(f"Loading prompt from {prompt}...")
         with open(prompt) as f:
             prompt = f.read().strip()
 
-    # 2. Compute candidate captions for each image (If not already computed)
-    print(f"Loading caption engine {caption_engine}...")
-    captioner = CAPTION_ENGINES_CLI[caption_engine](
-        device="cuda" if torch.cuda.is_available() else "cpu",
-    )  # type: ignore
-    print(f"Generating candidates using {caption_engine}...")
-    for sample in tqdm.tqdm(samples):
-        if sample.get(candidate_key, None) is None or overwrite_candidates:
-            sample[candidate_key] = captioner(
-                Image.open(os.path.join(image_root_dir or ".", sample[image_path_key])).convert("RGB"),
-                n_captions=num_candidates,
-                temperature=candidate_temperature,
-            )
+    # 1.3 Load the pre-decoded images (if they exist)
+    image_store = None
+    if packed_images is not None:
+        print(f"Loading packed images from {packed_images}...")
+        image_store = PackedImages(packed_images)
+
+    # 1.4 Resolve the image paths once, rather than in each of the loops over the samples
+    image_paths = [os.path.join(image_root_dir or ".", sample[image_path_key]) for sample in samples]
+
+    # 2-3. Compute the candidates, plugin outputs and summaries for each image (if not already computed), sharding
+    # the samples across the GPUs when there are several
+    generate_kwargs = dict(
+        caption_engine=caption_engine,
+        lm_engine=lm_engine,
+        lm_precision=lm_precision,
+        lm_compile=lm_compile,
+        plugin=plugin,
+        num_candidates=num_candidates,
+        candidate_temperature=candidate_temperature,
+        gpu_batch_size=gpu_batch_size,
+        plugin_batch_size=plugin_batch_size,
+        llm_batch_size=llm_batch_size,
+        summary_max_new_tokens=summary_max_new_tokens,
+        summary_beams=summary_beams,
+        prompt=prompt,
+        candidate_key=candidate_key,
+        reference_key=reference_key,
+        image_paths=image_paths,
+        image_store=image_store,
+        overwrite_candidates=overwrite_candidates,
+        overwrite_candidate_summaries=overwrite_candidate_summaries,
+    )
+    if num_gpus > 1:
+        devices = _get_visible_devices()
+        if num_gpus > len(devices):
+            raise ValueError(f"--num-gpus is {num_gpus}, but only {len(devices)} GPUs are visible: {devices}")
+        shards = _shard_indices(len(samples), num_gpus)
+        print(f"Generating on {num_gpus} GPUs ({', '.join(str(len(shard)) for shard in shards)} samples each)...")
+        torch.multiprocessing.spawn(
+            _generate_worker,
+            args=(samples, shards, devices, checkpoint_path, checkpoint_header, generate_kwargs),
+            nprocs=num_gpus,
+        )
+        # Merge the outputs of each of the workers back in (in order), and fold them into the main checkpoint
+        _merge_shard_checkpoints(checkpoint_path, checkpoint_header, samples)
+    else:
+        _generate_candidates_and_summaries(
+            samples,
+            range(len(samples)),
+            checkpoint_path,
+            checkpoint_header,
+            device="cuda" if torch.cuda.is_available() else "cpu",
+            **generate_kwargs,
+        )
+
+    for sample in samples:
         # The baseline is always the first candidate
         if sample.get("baseline", None) is None or overwrite_candidates:
             sample["baseline"] = sample[candidate_key][0]  # type: ignore
 
+    # 4. Compute the metrics (Bleu, ROUGE, METEOR, CIDEr, SPICE) for each image (if not already computed)
+    print("Computing base metrics...")
+    samples = compute_and_add_base_metrics(samples, reference_key)
+
+    # Save the output to a temporary file which will persist in case of a crash
+    _rewrite_jsonl(checkpoint_path, checkpoint_header, samples)
+
+    # 5. Compute the overall Mauve score for each set of samples (if not already computed)
+    print("Computing Mauve score...")
+    samples = compute_and_add_mauve_score(samples, reference_key)
+    _release_gpu_memory()
+
+    # Save the output to a temporary file which will persist in case of a crash
+    _rewrite_jsonl(checkpoint_path, checkpoint_header, samples)
+
+    # 6. Compute the CLIP Recall for each set of candidates (if not already computed)
+    print("Computing CLIP recall...")
+    image_feature_cache = load_image_feature_cache(f"{output_json_path}.features.npz")
+    samples = compute_and_add_clip_recall(
+        samples, image_path_key, image_root_dir, feature_cache=image_feature_cache, half_precision=clip_fp16
+    )
+    save_image_feature_cache(f"{output_json_path}.features.npz", image_feature_cache)
+    release_clip_model()
+    _release_gpu_memory()
+
+    # Save the output to a temporary file which will persist in case of a crash
+    _rewrite_jsonl(checkpoint_path, checkpoint_header, samples)
+
+    # 7. Compute the Content Recall for each set of candidates (if not already computed)
+    print("Computing Content recall...")
+    samples = compute_and_add_content_recall(samples, reference_key, num_workers=num_metric_workers)
+
+    # 8. Compute the Self-BLEU for the candidates/references (if not already computed)
+    print("Computing Self-BLEU...")
+    samples = compute_and_add_self_bleu(samples, candidate_key, reference_key, num_workers=num_metric_workers)
+
+    # 9. Compute the hallucination metrics for each set of candidates (if not already computed)
+    print("Computing Object Hallucinations...")
+    samples = compute_and_add_object_hallucinations(samples, candidate_key, reference_key)
+
     # Save the output to a temporary file which will persist in case of a crash
-    _save_json_tmp_file(output_json_path, samples)
+    _rewrite_jsonl(checkpoint_path, checkpoint_header, samples)
+
+    # 8. Aggregate the metrics across all images
+    metrics = _extract_and_aggregate_metrics(samples)
+
+    # 8. Save the results to a JSON file (atomically, so a crash never leaves a partially written output)
+    with open(f"{output_json_path}.new", "wb") as f:
+        f.write(orjson.dumps({"samples": samples, "metrics": metrics}, option=_ORJSON_OPTIONS | orjson.OPT_INDENT_2))
+    os.replace(f"{output_json_path}.new", output_json_path)
+
+    # Remove the checkpoint
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    # 9. Print the results to the console
+    print(json.dumps(metrics, indent=2))
+
+
+def _generate_candidates_and_summaries(
+    samples: List[Dict[str, Any]],
+    shard: range,
+    checkpoint_path: str,
+    checkpoint_header: Dict[str, Any],
+    device: str,
+    caption_engine: str,
+    lm_engine: str,
+    lm_precision: str,
+    lm_compile: bool,
+    plugin: List[str],
+    num_candidates: int,
+    candidate_temperature: float,
+    gpu_batch_size: int,
+    plugin_batch_size: int,
+    llm_batch_size: int,
+    summary_max_new_tokens: int,
+    summary_beams: int,
+    prompt: str,
+    candidate_key: str,
+    reference_key: str,
+    image_paths: List[str],
+    image_store: Optional[PackedImages],
+    overwrite_candidates: bool,
+    overwrite_candidate_summaries: bool,
+) -> None:
+    # 2. Compute candidate captions for each image (If not already computed)
+    print(f"Loading caption engine {caption_engine}...")
+    captioner = CAPTION_ENGINES_CLI[caption_engine](device=device)  # type: ignore
+    print(f"Generating candidates using {caption_engine}...")
+    candidate_inputs = [
+        (index, image_paths[index])
+        for index in shard
+        if samples[index].get(candidate_key, None) is None or overwrite_candidates
+    ]
+    pending: List[Tuple[int, Image.Image]] = []
+    for index, image in tqdm.tqdm(
+        _prefetch_images(candidate_inputs, prefetch=gpu_batch_size * 2, image_store=image_store),
+        total=len(candidate_inputs),
+    ):
+        pending.append((index, image))
+        if len(pending) >= gpu_batch_size:
+            captions = captioner.batch(
+                [img for _, img in pending], n_captions=num_candidates, temperature=candidate_temperature
+            )
+            _distribute_captions(samples, [idx for idx, _ in pending], captions, candidate_key)
+            _append_jsonl(checkpoint_path, checkpoint_header, samples, [idx for idx, _ in pending])
+            pending = []
+    # Flush the trailing partial batch
+    if pending:
+        captions = captioner.batch(
+            [img for _, img in pending], n_captions=num_candidates, temperature=candidate_temperature
+        )
+        _distribute_captions(samples, [idx for idx, _ in pending], captions, candidate_key)
+        _append_jsonl(checkpoint_path, checkpoint_header, samples, [idx for idx, _ in pending])
+
+    # The captioner is not needed anymore, so free its memory before the plugins/LM are loaded
+    del captioner
+    _release_gpu_memory()
 
     # 2.1 Compute the plugin features for each image (if not already computed)
     for plugin_name in plugin:
         print(f"Loading plugin {plugin_name}...")
         pl = IMAGE_PLUGINS[plugin_name]()
         print(f"Computing plugin output for {plugin_name}...")
-        for sample in tqdm.tqdm(samples):
+        plugin_inputs = []
+        for index in shard:
+            sample = samples[index]
             if sample.get("plugin_outputs", None) is None:
                 sample["plugin_outputs"] = {}
             if sample["plugin_outputs"].get(plugin_name, None) is None or overwrite_candidates:
-                sample["plugin_outputs"][plugin_name] = pl(
-                    Image.open(os.path.join(image_root_dir or ".", sample[image_path_key])).convert("RGB")
-                )
-
-    # Save the output to a temporary file which will persist in case of a crash
-    _save_json_tmp_file(output_json_path, samples)
+                plugin_inputs.append((index, image_paths[index]))
+        for indices, images in tqdm.tqdm(_get_image_loader(plugin_inputs, plugin_batch_size, image_store=image_store)):
+            for index, output in zip(indices, pl.batch(images)):
+                samples[index]["plugin_outputs"][plugin_name] = output
+            _append_jsonl(checkpoint_path, checkpoint_header, samples, indices)
+        del pl
+        _release_gpu_memory()
 
     # 3. Compute the summary captions for each image (both candidate + reference summaries, if not already computed)
     print(f"Loading LM engine {lm_engine}...")
-    if lm_engine in LM_LOCAL_ENGINES:
-        lm = LM_ENGINES_CLI[lm_engine](device="cuda" if torch.cuda.is_available() else "cpu")  # type: ignore
+    if lm_engine in LM_LOCAL_ENGINES and issubclass(LM_ENGINES_CLI[lm_engine], HuggingFaceLlamaLMEngine):
+        lm = LM_ENGINES_CLI[lm_engine](device=device, precision=lm_precision, compile_model=lm_compile)  # type: ignore
+    elif lm_engine in LM_LOCAL_ENGINES and issubclass(LM_ENGINES_CLI[lm_engine], VLLMLlamaLMEngine):
+        lm = LM_ENGINES_CLI[lm_engine](device=device, precision=lm_precision)  # type: ignore
+    elif lm_engine in LM_LOCAL_ENGINES:
+        lm = LM_ENGINES_CLI[lm_engine](device=device)  # type: ignore
     else:
         lm = LM_ENGINES_CLI[lm_engine]()
 
+    # The prompt is identical for every sample up to the first template field, so the LM only needs to process it once
+    lm.cache_prompt_prefix(prompt.partition("{")[0])
+    # Summaries are a single sentence, so there is no need to search widely or generate for long
+    lm.configure_best(max_new_tokens=summary_max_new_tokens, num_beams=summary_beams)
+
     print(f"Generating summaries using {lm_engine}...")
     overwrite_candidate_summaries = overwrite_candidate_summaries or overwrite_candidates
-    for sample in tqdm.tqdm(samples):
+    pending_summaries: List[Tuple[int, str]] = []
+    summary_cache: Dict[str, str] = {}
+    for index in tqdm.tqdm(shard):
+        sample = samples[index]
         if sample.get("candidate_summary") is None or overwrite_candidate_summaries:
             sample["candidate_summary_prompt"] = get_prompt_for_candidates(
                 sample[candidate_key], prompt=prompt, plugin_outputs=list(sample.get("plugin_outputs", {}).values())
             )
-            sample["candidate_summary"] = postprocess_caption(lm.best(prompt=sample["candidate_summary_prompt"]))
+            pending_summaries.append((index, "candidate_summary"))
         if sample.get("reference_summary") is None or overwrite_candidate_summaries:
             sample["reference_summary_prompt"] = get_prompt_for_candidates(
                 sample[reference_key], prompt=prompt, plugin_outputs=list(sample.get("plugin_outputs", {}).values())
             )
-            sample["reference_summary"] = postprocess_caption(lm.best(prompt=sample["reference_summary_prompt"]))
+            pending_summaries.append((index, "reference_summary"))
+        if len(pending_summaries) >= llm_batch_size:
+            _generate_summaries(lm, samples, pending_summaries, summary_cache)
+            _append_jsonl(checkpoint_path, checkpoint_header, samples, sorted({idx for idx, _ in pending_summaries}))
+            pending_summaries = []
+    # Flush the trailing partial batch
+    if pending_summaries:
+        _generate_summaries(lm, samples, pending_summaries, summary_cache)
+        _append_jsonl(checkpoint_path, checkpoint_header, samples, sorted({idx for idx, _ in pending_summaries}))
 
-    # Save the output to a temporary file which will persist in case of a crash
-    _save_json_tmp_file(output_json_path, samples)
+    # Free the LM before the metrics load their own models. LM engines are singletons, so the class holds on to the
+    # instance as well.
+    lm.release()
+    lm_class = type(lm)
+    del lm
+    getattr(lm_class, "clear_instance", lambda: None)()
+    _release_gpu_memory()
 
-    # 4. Compute the metrics (Bleu, ROUGE, METEOR, CIDEr, SPICE) for each image (if not already computed)
-    print("Computing base metrics...")
-    samples = compute_and_add_base_metrics(samples, reference_key)
 
-    # Save the output to a temporary file which will persist in case of a crash
-    _save_json_tmp_file(output_json_path, samples)
+def _shard_indices(num_samples: int, num_shards: int) -> List[range]:
+    # Contiguous ranges, with the remainder spread over the first few shards
+    shard_size, remainder = divmod(num_samples, num_shards)
+    shards = []
+    start = 0
+    for rank in range(num_shards):
+        end = start + shard_size + (1 if rank < remainder else 0)
+        shards.append(range(start, end))
+        start = end
+    return shards
 
-    # 5. Compute the overall Mauve score for each set of samples (if not already computed)
-    print("Computing Mauve score...")
-    samples = compute_and_add_mauve_score(samples, reference_key)
 
-    # Save the output to a temporary file which will persist in case of a crash
-    _save_json_tmp_file(output_json_path, samples)
+def _get_visible_devices() -> List[str]:
+    # The GPUs this process may use, respecting any CUDA_VISIBLE_DEVICES the run was started with
+    visible_devices = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if visible_devices is not None:
+        return [device.strip() for device in visible_devices.split(",") if device.strip()]
+    return [str(index) for index in range(torch.cuda.device_count())]
 
-    # 6. Compute the CLIP Recall for each set of candidates (if not already computed)
-    print("Computing CLIP recall...")
-    samples = compute_and_add_clip_recall(samples, image_path_key, image_root_dir)
 
-    # Save the output to a temporary file which will persist in case of a crash
-    _save_json_tmp_file(output_json_path, samples)
+def _generate_worker(
+    rank: int,
+    samples: List[Dict[str, Any]],
+    shards: List[range],
+    devices: List[str],
+    checkpoint_path: str,
+    checkpoint_header: Dict[str, Any],
+    generate_kwargs: Dict[str, Any],
+) -> None:
+    # Each worker only sees its own GPU out of the visible ones (CUDA is not initialized until the models are loaded),
+    # and writes to its own checkpoint so that the workers never interleave their writes
+    os.environ["CUDA_VISIBLE_DEVICES"] = devices[rank]
+    _generate_candidates_and_summaries(
+        samples,
+        shards[rank],
+        f"{checkpoint_path}.{rank}",
+        checkpoint_header,
+        device="cuda" if torch.cuda.is_available() else "cpu",
+        **generate_kwargs,
+    )
 
-    # 7. Compute the Content Recall for each set of candidates (if not already computed)
-    print("Computing Content recall...")
-    samples = compute_and_add_content_recall(samples, reference_key)
 
-    # 8. Compute the Self-BLEU for the candidates/references (if not already computed)
-    print("Computing Self-BLEU...")
-    samples = compute_and_add_self_bleu(samples, candidate_key, reference_key)
+def _merge_shard_checkpoints(checkpoint_path: str, header: Dict[str, Any], samples: List[Dict[str, Any]]) -> None:
+    # A worker which had nothing left to do never creates its checkpoint, so look for all of them
+    shard_paths = [p for p in glob.glob(f"{glob.escape(checkpoint_path)}.*") if p.rsplit(".", 1)[1].isdigit()]
+    for shard_path in sorted(shard_paths, key=lambda path: int(path.rsplit(".", 1)[1])):
+        indices = _load_jsonl(shard_path, header, samples)
+        _append_jsonl(checkpoint_path, header, samples, indices)
+        os.remove(shard_path)
 
-    # 9. Compute the hallucination metrics for each set of candidates (if not already computed)
-    print("Computing Object Hallucinations...")
-    samples = compute_and_add_object_hallucinations(samples, candidate_key, reference_key)
 
-    # Save the output to a temporary file which will persist in case of a crash
-    _save_json_tmp_file(output_json_path, samples)
+def _release_gpu_memory() -> None:
+    # Collect the (now unreferenced) models, and hand their cached blocks back to the driver
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
 
-    # 8. Aggregate the metrics across all images
-    metrics = _extract_and_aggregate_metrics(samples)
 
-    # 8. Save the results to a JSON file
-    with open(output_json_path, "w") as f:
-        json.dump({"samples": samples, "metrics": metrics}, f, indent=2)
+def _load_image(image_path: str, image_store: Optional[PackedImages] = None) -> Image.Image:
+    if image_store is not None and image_path in image_store:
+        return image_store[image_path]
+    return Image.open(image_path).convert("RGB")
 
-    # Remove the temporary file
-    if os.path.exists(f"{output_json_path}.tmp"):
-        os.remove(f"{output_json_path}.tmp")
 
-    # 9. Print the results to the console
-    print(json.dumps(metrics, indent=2))
+def _prefetch_images(
+    image_paths: List[Tuple[int, str]],
+    prefetch: int,
+    max_workers: int = 8,
+    image_store: Optional[PackedImages] = None,
+) -> Iterator[Tuple[int, Image.Image]]:
+    # Read and decode the next few images in background threads while the current batch is on the GPU. Images are
+    # yielded in the same order as the paths.
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures: Deque[Tuple[int, Future]] = deque()
+        for index, image_path in image_paths:
+            futures.append((index, executor.submit(_load_image, image_path, image_store)))
+            if len(futures) > prefetch:
+                next_index, next_image = futures.popleft()
+                yield next_index, next_image.result()
+        while futures:
+            next_index, next_image = futures.popleft()
+            yield next_index, next_image.result()
+
+
+class _ImageDataset(Dataset):
+    def __init__(self, image_paths: List[Tuple[int, str]], image_store: Optional[PackedImages] = None) -> None:
+        self._image_paths = image_paths
+        self._image_store = image_store
+
+    def __len__(self) -> int:
+        return len(self._image_paths)
+
+    def __getitem__(self, index: int) -> Tuple[int, Image.Image]:
+        sample_index, image_path = self._image_paths[index]
+        return sample_index, _load_image(image_path, self._image_store)
+
+
+def _collate_images(batch: List[Tuple[int, Image.Image]]) -> Tuple[List[int], List[Image.Image]]:
+    return [index for index, _ in batch], [image for _, image in batch]
+
+
+def _get_image_loader(
+    image_paths: List[Tuple[int, str]], batch_size: int, image_store: Optional[PackedImages] = None
+) -> DataLoader:
+    # Decode the images in background workers, so that the next batch is ready as soon as the plugin is done
+    num_workers = (os.cpu_count() or 0) // 2
+    return DataLoader(
+        _ImageDataset(image_paths, image_store),
+        batch_size=batch_size,
+        num_workers=num_workers,
+        collate_fn=_collate_images,
+        **({"prefetch_factor": 4} if num_workers > 0 else {}),
+    )
+
+
+def _distribute_captions(
+    samples: List[Dict[str, Any]], indices: List[int], captions: List[List[str]], candidate_key: str
+) -> None:
+    for index, sample_captions in zip(indices, captions):
+        samples[index][candidate_key] = sample_captions
+
+
+def _generate_summaries(
+    lm: LMEngine, samples: List[Dict[str, Any]], pending: List[Tuple[int, str]], summary_cache: Dict[str, str]
+) -> None:
+    # Many samples can end up with exactly the same prompt, so only generate once for each unique prompt
+    prompts = [samples[index][f"{summary_key}_prompt"] for index, summary_key in pending]
+    unique_prompts = [p for p in dict.fromkeys(prompts) if p not in summary_cache]
+    if unique_prompts:
+        summary_cache.update(zip(unique_prompts, lm.best_batch(unique_prompts)))
+    for (index, summary_key), prompt in zip(pending, prompts):
+        samples[index][summary_key] = postprocess_caption(summary_cache[prompt])
+
+
+def _get_checkpoint_header(dataset_json_path: str, samples: List[Dict[str, Any]]) -> Dict[str, Any]:
+    # Identifies the dataset a checkpoint was written for, since the samples in it are only keyed by their index
+    return {"dataset": os.path.abspath(dataset_json_path), "num_samples": len(samples)}
+
+
+def _append_jsonl(
+    checkpoint_path: str, header: Dict[str, Any], samples: List[Dict[str, Any]], indices: Iterable[int]
+) -> None:
+    # The first line is the header, and each line after it records the current state of one sample. Later lines take
+    # precedence over earlier ones.
+    with open(checkpoint_path, "ab") as f:
+        if f.tell() == 0:
+            f.write(orjson.dumps(header) + b"\n")
+        for index in indices:
+            f.write(orjson.dumps({"index": index, "sample": samples[index]}, option=_ORJSON_OPTIONS) + b"\n")
 
 
-def _save_json_tmp_file(output_json_path: str, samples: List[Dict[str, Any]]) -> None:
-    with open(f"{output_json_path}.tmp", "w") as f:
-        json.dump(samples, f)
+def _rewrite_jsonl(checkpoint_path: str, header: Dict[str, Any], samples: List[Dict[str, Any]]) -> None:
+    # Replace the checkpoint with a single line per sample, rather than appending every sample again after each of the
+    # metrics. The new checkpoint is written to a separate file first, so a crash leaves either the old or the new one.
+    new_checkpoint_path = f"{checkpoint_path}.new"
+    if os.path.exists(new_checkpoint_path):
+        os.remove(new_checkpoint_path)
+    _append_jsonl(new_checkpoint_path, header, samples, range(len(samples)))
+    os.replace(new_checkpoint_path, checkpoint_path)
+
+
+def _load_jsonl(checkpoint_path: str, header: Dict[str, Any], samples: List[Dict[str, Any]]) -> List[int]:
+    # Returns the (unique, sorted) indices of the samples which were loaded
+    indices = set()
+    with open(checkpoint_path, "r+b") as f:
+        offset = 0
+        for line in f:
+            if not line.endswith(b"\n"):
+                # The last line may have been cut off by the crash. Drop it, so that the next append starts a new line.
+                f.truncate(offset)
+                break
+            record = orjson.loads(line)
+            if offset == 0:
+                if record != header:
+                    raise ValueError(
+                        f"Checkpoint {checkpoint_path} was written for {record}, not {header}. Delete it to start over."
+                    )
+            else:
+                samples[record["index"]] = record["sample"]
+                indices.add(record["index"])
+            offset += len(line)
+    return sorted(indices)
+
+
+def _mean_scores(score_dicts: List[Dict[str, Any]], keys: List[str]) -> np.ndarray:
+    # Pull all of the keys out of each dict in a single (C-level) call, and take the column means
+    getter = itemgetter(*keys) if len(keys) > 1 else lambda d: (d[keys[0]],)
+    values = np.fromiter(
+        itertools.chain.from_iterable(map(getter, score_dicts)), dtype=np.float64, count=len(score_dicts) * len(keys)
+    )
+    return values.reshape(len(score_dicts), len(keys)).mean(axis=0)
 
 
 def _extract_and_aggregate_metrics(samples: List[Dict[str, Any]]) -> Dict[str, Dict[str, float]]:
-    return {
-        "standard": {
-            # Base Scores
-            "candidate_summary_bleu_1": float(np.mean([s["scores"]["candidate_summary_bleu_1"] for s in samples])),
-            "candidate_summary_bleu_2": float(np.mean([s["scores"]["candidate_summary_bleu_2"] for s in samples])),
-            "candidate_summary_bleu_3": float(np.mean([s["scores"]["candidate_summary_bleu_3"] for s in samples])),
-            "candidate_summary_bleu_4": float(np.mean([s["scores"]["candidate_summary_bleu_4"] for s in samples])),
-            "candidate_summary_rouge": float(np.mean([s["scores"]["candidate_summary_rouge"] for s in samples])),
-            "candidate_summary_cider": float(np.mean([s["scores"]["candidate_summary_cider"] for s in samples])),
-            "reference_summary_bleu_1": float(np.mean([s["scores"]["reference_summary_bleu_1"] for s in samples])),
-            "reference_summary_bleu_2": float(np.mean([s["scores"]["reference_summary_bleu_2"] for s in samples])),
-            "reference_summary_bleu_3": float(np.mean([s["scores"]["reference_summary_bleu_3"] for s in samples])),
-            "reference_summary_bleu_4": float(np.mean([s["scores"]["reference_summary_bleu_4"] for s in samples])),
-            "reference_summary_rouge": float(np.mean([s["scores"]["reference_summary_rouge"] for s in samples])),
-            "reference_summary_cider": float(np.mean([s["scores"]["reference_summary_cider"] for s in samples])),
-            "baseline_bleu_1": float(np.mean([s["scores"]["baseline_bleu_1"] for s in samples])),
-            "baseline_bleu_2": float(np.mean([s["scores"]["baseline_bleu_2"] for s in samples])),
-            "baseline_bleu_3": float(np.mean([s["scores"]["baseline_bleu_3"] for s in samples])),
-            "baseline_bleu_4": float(np.mean([s["scores"]["baseline_bleu_4"] for s in samples])),
-            "baseline_rouge": float(np.mean([s["scores"]["baseline_rouge"] for s in samples])),
-            "baseline_cider": float(np.mean([s["scores"]["baseline_cider"] for s in samples])),
-            # Mauve Scores
-            "candidate_summary_mauve": float(np.mean([s["scores"]["candidate_summary_mauve"] for s in samples])),
-            "reference_summary_mauve": float(np.mean([s["scores"]["reference_summary_mauve"] for s in samples])),
-            "baseline_mauve": float(np.mean([s["scores"]["baseline_mauve"] for s in samples])),
-            # Self-BLEU
-            "candidate_self_bleu": float(np.mean([s["scores"]["self_bleu"]["candidates"] for s in samples])),
-            "reference_self_bleu": float(np.mean([s["scores"]["self_bleu"]["references"] for s in samples])),
-        },
-        # CLIP Scores
-        "clip_recall": {
-            "candidate_summary_clip_recall_rank": float(
-                np.mean([s["scores"]["candidate_summary_clip_recall_rank"] for s in samples])
-            ),
-            "candidate_summary_clip_recall_mrr": float(
-                np.mean([s["scores"]["candidate_summary_clip_recall_mrr"] for s in samples])
-            ),
-            "candidate_summary_clip_recall_at_1": float(
-                np.mean([s["scores"]["candidate_summary_clip_recall_at_1"] for s in samples])
-            ),
-            "candidate_summary_clip_recall_at_5": float(
-                np.mean([s["scores"]["candidate_summary_clip_recall_at_5"] for s in samples])
-            ),
-            "candidate_summary_clip_recall_at_10": float(
-                np.mean([s["scores"]["candidate_summary_clip_recall_at_10"] for s in samples])
-            ),
-            "candidate_summary_clip_recall_max_rank": float(
-                np.mean([s["scores"]["candidate_summary_clip_recall_max_rank"] for s in samples])
-            ),
-            "reference_summary_clip_recall_rank": float(
-                np.mean([s["scores"]["reference_summary_clip_recall_rank"] for s in samples])
-            ),
-            "reference_summary_clip_recall_mrr": float(
-                np.mean([s["scores"]["reference_summary_clip_recall_mrr"] for s in samples])
-            ),
-            "reference_summary_clip_recall_at_1": float(
-                np.mean([s["scores"]["reference_summary_clip_recall_at_1"] for s in samples])
-            ),
-            "reference_summary_clip_recall_at_5": float(
-                np.mean([s["scores"]["reference_summary_clip_recall_at_5"] for s in samples])
-            ),
-            "reference_summary_clip_recall_at_10": float(
-                np.mean([s["scores"]["reference_summary_clip_recall_at_10"] for s in samples])
-            ),
-            "reference_summary_clip_recall_max_rank": float(
-                np.mean([s["scores"]["reference_summary_clip_recall_max_rank"] for s in samples])
-            ),
-            "baseline_clip_recall_rank": float(np.mean([s["scores"]["baseline_clip_recall_rank"] for s in samples])),
-            "baseline_clip_recall_mrr": float(np.mean([s["scores"]["baseline_clip_recall_mrr"] for s in samples])),
-            "baseline_clip_recall_at_1": float(np.mean([s["scores"]["baseline_clip_recall_at_1"] for s in samples])),
-            "baseline_clip_recall_at_5": float(np.mean([s["scores"]["baseline_clip_recall_at_5"] for s in samples])),
-            "baseline_clip_recall_at_10": float(np.mean([s["scores"]["baseline_clip_recall_at_10"] for s in samples])),
-            "baseline_clip_recall_max_rank": float(
-                np.mean([s["scores"]["baseline_clip_recall_max_rank"] for s in samples])
-            ),
-        },
-        # Content Scores
-        "content_recall": {
-            "candidate_summary_noun_recall": float(
-                np.mean([s["scores"]["content_recall"]["candidate_summary_noun_recall"] for s in samples])
-            ),
-            "candidate_summary_verb_recall": float(
-                np.mean([s["scores"]["content_recall"]["candidate_summary_verb_recall"] for s in samples])
-            ),
-            "candidate_summary_noun_fuzzy_recall": float(
-                np.mean([s["scores"]["content_recall"]["candidate_summary_noun_fuzzy_recall"] for s in samples])
-            ),
-            "candidate_summary_verb_fuzzy_recall": float(
-                np.mean([s["scores"]["content_recall"]["candidate_summary_verb_fuzzy_recall"] for s in samples])
-            ),
-            "reference_summary_noun_recall": float(
-                np.mean([s["scores"]["content_recall"]["reference_summary_noun_recall"] for s in samples])
-            ),
-            "reference_summary_verb_recall": float(
-                np.mean([s["scores"]["content_recall"]["reference_summary_verb_recall"] for s in samples])
-            ),
-            "reference_summary_noun_fuzzy_recall": float(
-                np.mean([s["scores"]["content_recall"]["reference_summary_noun_fuzzy_recall"] for s in samples])
-            ),
-            "reference_summary_verb_fuzzy_recall": float(
-                np.mean([s["scores"]["content_recall"]["reference_summary_verb_fuzzy_recall"] for s in samples])
-            ),
-            "baseline_noun_recall": float(
-                np.mean([s["scores"]["content_recall"]["baseline_noun_recall"] for s in samples])
-            ),
-            "baseline_verb_recall": float(
-                np.mean([s["scores"]["content_recall"]["baseline_verb_recall"] for s in samples])
-            ),
-            "baseline_noun_fuzzy_recall": float(
-                np.mean([s["scores"]["content_recall"]["baseline_noun_fuzzy_recall"] for s in samples])
-            ),
-            "baseline_verb_fuzzy_recall": float(
-                np.mean([s["scores"]["content_recall"]["baseline_verb_fuzzy_recall"] for s in samples])
-            ),
-        },
+    scores = [s["scores"] for s in samples]
+    hallucinated_object_counts = np.fromiter(
+        (s["hallucinated_object_count"] for s in samples), dtype=np.float64, count=len(samples)
+    )
+    object_counts = np.fromiter((s["object_count"] for s in samples), dtype=np.float64, count=len(samples))
+
+    metrics: Dict[str, Dict[str, float]] = {
+        "standard": {},
+        "clip_recall": {},
+        "content_recall": {},
         # Hallucination Scores
         "hallucinations": {
-            "hallucinated_objects_percentage": float(np.sum([s["hallucinated_object_count"] for s in samples]))
-            / float(np.sum([s["object_count"] for s in samples])),
-            "hallucinated_captions_percentage": float(
-                np.sum([1 for s in samples if s["hallucinated_object_count"] > 0])
-            )
-            / float(len(samples)),
-            "average_hungarian_matching_score": float(
-                np.mean([s["scores"]["hungarian_matching_score"] for s in samples])
-            ),
+            "hallucinated_objects_percentage": float(hallucinated_object_counts.sum()) / float(object_counts.sum()),
+            "hallucinated_captions_percentage": float((hallucinated_object_counts > 0).sum()) / float(len(samples)),
         },
     }
+    for group, score_path, score_keys, output_keys in _METRIC_SCHEMA:
+        score_dicts = [reduce(getitem, score_path, s) for s in scores] if score_path else scores
+        metrics[group].update(zip(output_keys, map(float, _mean_scores(score_dicts, score_keys))))
+    return metrics
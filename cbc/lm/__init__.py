@@ -50,6 +50,19 @@ from .openai_engine import (  # noqa: F401
     GPT3Davinci3,
     OpenAI,
 )
+from .vllm_engine import (  # noqa: F401
+    VLLMAlpaca7B,
+    VLLMKoala7B,
+    VLLMKoala13B_V1,
+    VLLMKoala13B_V2,
+    VLLMLlama7B,
+    VLLMLlama13B,
+    VLLMLlama30B,
+    VLLMLlama65B,
+    VLLMLlamaLMEngine,
+    VLLMVicuna_7B,
+    VLLMVicuna_13B,
+)
 
 LM_ENGINES: Dict[str, Type[LMEngine]] = {
     "ChatGPT": ChatGPT,
@@ -84,6 +97,16 @@ LM_ENGINES: Dict[str, Type[LMEngine]] = {
     "Koala 13B V2": Koala13B_V2,
     "Vicuna 7B": Vicuna_7B,
     "Vicuna 13B": Vicuna_13B,
+    "LLama 7B (vLLM)": VLLMLlama7B,
+    "LLama 13B (vLLM)": VLLMLlama13B,
+    "LLama 30B (vLLM)": VLLMLlama30B,
+    "LLama 65B (vLLM)": VLLMLlama65B,
+    "Alpaca 7B (vLLM)": VLLMAlpaca7B,
+    "Koala 7B (vLLM)": VLLMKoala7B,
+    "Koala 13B V1 (vLLM)": VLLMKoala13B_V1,
+    "Koala 13B V2 (vLLM)": VLLMKoala13B_V2,
+    "Vicuna 7B (vLLM)": VLLMVicuna_7B,
+    "Vicuna 13B (vLLM)": VLLMVicuna_13B,
     "Stable LM (3B)": StableLM3B,
     "Stable LM (7B)": StableLM7B,
     "Stable LM Base (3B)": StableLMBase3B,
@@ -124,6 +147,16 @@ LM_ENGINES_CLI: Dict[str, Type[LMEngine]] = {
     "koala_13B_v2": Koala13B_V2,
     "vicuna_7B": Vicuna_7B,
     "vicuna_13B": Vicuna_13B,
+    "vllm_llama_7B": VLLMLlama7B,
+    "vllm_llama_13B": VLLMLlama13B,
+    "vllm_llama_30B": VLLMLlama30B,
+    "vllm_llama_65B": VLLMLlama65B,
+    "vllm_alpaca_7B": VLLMAlpaca7B,
+    "vllm_koala_7B": VLLMKoala7B,
+    "vllm_koala_13B_v1": VLLMKoala13B_V1,
+    "vllm_koala_13B_v2": VLLMKoala13B_V2,
+    "vllm_vicuna_7B": VLLMVicuna_7B,
+    "vllm_vicuna_13B": VLLMVicuna_13B,
     "stable_lm_3B": StableLM3B,
     "stable_lm_7B": StableLM7B,
     "stable_lm_base_3B": StableLMBase3B,
@@ -166,6 +199,16 @@ LM_LOCAL_ENGINES: Set[str] = {
     "koala_13B_v2",
     "vicuna_7B",
     "vicuna_13B",
+    "vllm_llama_7B",
+    "vllm_llama_13B",
+    "vllm_llama_30B",
+    "vllm_llama_65B",
+    "vllm_alpaca_7B",
+    "vllm_koala_7B",
+    "vllm_koala_13B_v1",
+    "vllm_koala_13B_v2",
+    "vllm_vicuna_7B",
+    "vllm_vicuna_13B",
     "stable_lm_3B",
     "stable_lm_7B",
     "stable_lm_base_3B",
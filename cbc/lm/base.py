@@ -13,6 +13,23 @@ class LMEngine(ABC):
     def best(self, prompt: str) -> str:
         raise NotImplementedError()
 
+    def best_batch(self, prompts: List[str]) -> List[str]:
+        # Engines which can generate for several prompts at once should override this
+        return [self.best(prompt) for prompt in prompts]
+
+    def cache_prompt_prefix(self, prefix: str) -> None:
+        # Engines which can reuse the computation for a prefix shared by many prompts should override this
+        pass
+
+    def configure_best(self, max_new_tokens: int, num_beams: int) -> None:
+        # Engines which control the length/beam search of best() (and best_batch()) should override this
+        pass
+
+    def release(self) -> None:
+        # Engines which hold resources that garbage collection does not free (e.g. GPU memory allocated up front) should
+        # override this. The engine is not used again after it has been released.
+        pass
+
     @staticmethod
     def from_string(typestr: str, **kwargs: Any) -> "LMEngine":
         from cbc.lm import LM_ENGINES, LM_ENGINES_CLI
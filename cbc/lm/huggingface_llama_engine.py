@@ -1,57 +1,241 @@
+import contextlib
+import copy
+import importlib.util
 import os
-from typing import Any, List, Optional
+from typing import Any, Dict, Iterator, List, Literal, Optional, Tuple, Union
+
+import torch
+from packaging import version
+
+from cbc.lm.base import LMEngine
+from cbc.utils.python import singleton
 
 try:
     from transformers import LlamaForCausalLM, LlamaTokenizer
+    from transformers import __version__ as _TRANSFORMERS_VERSION
 except ImportError:
     LlamaForCausalLM = None
     LlamaTokenizer = None
+    _TRANSFORMERS_VERSION = "0"
 
-from cbc.lm.base import LMEngine
-from cbc.utils.python import singleton
+LlamaPrecision = Union[Literal["fp32"], Literal["fp16"], Literal["bf16"], Literal["int8"], Literal["int4"]]
 
+# int8/int4 weights are quantized with bitsandbytes, with the remaining computation in fp16
+_PRECISION_KWARGS: Dict[str, Dict[str, Any]] = {
+    "fp32": {"torch_dtype": torch.float32},
+    "fp16": {"torch_dtype": torch.float16},
+    "bf16": {"torch_dtype": torch.bfloat16},
+    "int8": {"torch_dtype": torch.float16, "load_in_8bit": True},
+    "int4": {"torch_dtype": torch.float16, "load_in_4bit": True},
+}
 
-class HuggingFaceLlamaLMEngine(LMEngine):
-    def __init__(self, model: str, weight_root: str, device: Optional[str] = None):
+# Passing a pre-computed past_key_values for a prompt prefix into generate() requires transformers >= 4.38.0
+_SUPPORTS_PREFIX_CACHE = version.parse(_TRANSFORMERS_VERSION) >= version.parse("4.38.0")
+
+# Choosing the attention kernel (SDPA/FlashAttention-2) in from_pretrained() requires transformers >= 4.36.0
+_SUPPORTS_ATTN_IMPLEMENTATION = version.parse(_TRANSFORMERS_VERSION) >= version.parse("4.36.0")
+
+
+def _get_attn_implementation_kwargs(precision: LlamaPrecision) -> Dict[str, Any]:
+    if not _SUPPORTS_ATTN_IMPLEMENTATION:
+        return {}
+    # FlashAttention-2 only runs in half precision, otherwise fall back to PyTorch's fused SDPA kernels
+    if precision in ("fp16", "bf16") and importlib.util.find_spec("flash_attn") is not None:
+        return {"attn_implementation": "flash_attention_2"}
+    return {"attn_implementation": "sdpa"}
+
+
+def _tokenize_continuations(tokenizer: Any, texts: List[str]) -> List[List[int]]:
+    # Token ids for texts which continue some earlier text. Sentencepiece adds a dummy-prefix "▁" to the start of every
+    # text it encodes, which it would not do in the middle of a prompt. So (like transformers does for legacy=False)
+    # encode each text behind the unk token, and drop the tokens of the unk token (and its dummy prefix).
+    sp_model = getattr(tokenizer, "sp_model", None)
+    if sp_model is None:
+        return tokenizer(texts, add_special_tokens=False).input_ids
+    anchor_length = len(sp_model.encode(tokenizer.unk_token))
+    return [sp_model.encode(tokenizer.unk_token + text)[anchor_length:] for text in texts]
 
+
+def _expand_past_key_values(past_key_values: Any, batch_size: int) -> Any:
+    # Repeat the cached prefix for each row of the batch. The result is a copy, since generate() extends the cache in
+    # place. Newer transformers versions return a Cache object rather than (key, value) tuples for each layer.
+    legacy = past_key_values.to_legacy_cache() if hasattr(past_key_values, "to_legacy_cache") else past_key_values
+    expanded = tuple(tuple(t.expand(batch_size, *t.shape[1:]).contiguous() for t in layer) for layer in legacy)
+    if hasattr(past_key_values, "from_legacy_cache"):
+        return type(past_key_values).from_legacy_cache(expanded)
+    return expanded
+
+
+class HuggingFaceLlamaLMEngine(LMEngine):
+    def __init__(
+        self,
+        model: str,
+        weight_root: str,
+        device: Optional[str] = None,
+        precision: LlamaPrecision = "fp16",
+        compile_model: bool = False,
+    ):
         if LlamaForCausalLM is None or LlamaTokenizer is None:
             raise ImportError("Please install the transformers >= 4.28.0 to use this LM engine.")
+        if precision not in _PRECISION_KWARGS:
+            raise ValueError(f"Invalid precision: {precision}, should be one of {list(_PRECISION_KWARGS.keys())}")
 
         self._device = device
-        self.tokenizer = LlamaTokenizer.from_pretrained(
-            f"{os.environ.get(weight_root, '')}{model}"
-        )
+        # Allow TF32 matmuls on Ampere (and newer) GPUs when running in full precision
+        self._allow_tf32 = precision == "fp32"
+        self.tokenizer = LlamaTokenizer.from_pretrained(f"{os.environ.get(weight_root, '')}{model}")
         self._generator = LlamaForCausalLM.from_pretrained(
-            f"{os.environ.get(weight_root, '')}{model}", device_map="auto"
+            f"{os.environ.get(weight_root, '')}{model}",
+            device_map="auto",
+            **_PRECISION_KWARGS[precision],
+            **_get_attn_implementation_kwargs(precision),
         )
+        self._prefix_cache: Optional[Tuple[List[int], Any]] = None
+        self._prefix_ids: Optional[Tuple[str, List[int]]] = None
+        self._prefix_ids_verified = False
+        self._best_max_new_tokens = 256
+        self._best_num_beams = 1
+
+        # Batched prompts are left-padded, so that generation continues directly from the end of each prompt
+        self.tokenizer.padding_side = "left"
+        if self.tokenizer.pad_token is None:
+            self.tokenizer.pad_token = self.tokenizer.unk_token
+
+        if compile_model:
+            # Compile the forward pass (which generate() calls for every token), and pay the compilation cost up front.
+            # generate() uses a dynamic KV cache whose length grows at every step, so the graph is compiled with dynamic
+            # shapes (and without CUDA graphs, which would need a static cache) to avoid recompiling at every step.
+            self._generator.forward = torch.compile(self._generator.forward, dynamic=True, fullgraph=False)
+            warmup_ids = self.tokenizer("Hello", return_tensors="pt").input_ids.to(self._generator.device)
+            with torch.inference_mode(), self._tf32_matmuls():
+                self._generator.generate(warmup_ids, max_new_tokens=4, do_sample=False, use_cache=True)
+
+    def cache_prompt_prefix(self, prefix: str) -> None:
+        if not prefix:
+            return
+
+        # Tokenize the prefix once, so that only the rest of each prompt has to be tokenized
+        self._prefix_ids = (prefix, self.tokenizer(prefix).input_ids)
+        self._prefix_ids_verified = False
+
+        if not _SUPPORTS_PREFIX_CACHE:
+            return
+
+        prefix_ids = torch.tensor([self._prefix_ids[1]], device=self._generator.device)
+        with torch.no_grad(), self._tf32_matmuls():
+            past_key_values = self._generator(prefix_ids, use_cache=True).past_key_values
+        self._prefix_cache = (self._prefix_ids[1], past_key_values)
+
+    @contextlib.contextmanager
+    def _tf32_matmuls(self) -> Iterator[None]:
+        # TF32 is a process-wide setting, so it is only switched on around the engine's own forward passes, and never
+        # leaks into the models which run later (e.g. CLIP for the recall metrics)
+        allow_tf32 = torch.backends.cuda.matmul.allow_tf32
+        torch.backends.cuda.matmul.allow_tf32 = allow_tf32 or self._allow_tf32
+        try:
+            yield
+        finally:
+            torch.backends.cuda.matmul.allow_tf32 = allow_tf32
+
+    def configure_best(self, max_new_tokens: int, num_beams: int) -> None:
+        self._best_max_new_tokens = max_new_tokens
+        self._best_num_beams = num_beams
+
+    def _get_best_generate_kwargs(self) -> Dict[str, Any]:
+        # Greedy (or beam search, if configured) decoding, stopping as soon as all of the beams are done
+        return {
+            "max_new_tokens": self._best_max_new_tokens,
+            "num_beams": self._best_num_beams,
+            "do_sample": False,
+            "num_return_sequences": 1,
+            "use_cache": True,
+            **({"early_stopping": True} if self._best_num_beams > 1 else {}),
+        }
+
+    def _tokenize(self, prompts: List[str]) -> Dict[str, torch.Tensor]:
+        input_ids = self._tokenize_ids(prompts)
+        return self.tokenizer.pad({"input_ids": input_ids}, return_tensors="pt").to(self._generator.device)
+
+    def _tokenize_ids(self, prompts: List[str]) -> List[List[int]]:
+        if self._prefix_ids is None or not all(p.startswith(self._prefix_ids[0]) for p in prompts):
+            return self.tokenizer(prompts).input_ids
+
+        prefix, prefix_ids = self._prefix_ids
+        suffix_ids = _tokenize_continuations(self.tokenizer, [p[len(prefix) :] for p in prompts])
+        input_ids = [prefix_ids + ids for ids in suffix_ids]
+        if not self._prefix_ids_verified:
+            # Tokenizing the prefix on its own could still split the text differently at the boundary (e.g. if the
+            # vocabulary has a token spanning it), so check once against tokenizing the whole prompt
+            if input_ids[0] != self.tokenizer(prompts[0]).input_ids:
+                self._prefix_ids = None
+                return self._tokenize_ids(prompts)
+            self._prefix_ids_verified = True
+
+        return input_ids
+
+    def _get_prefix_cache_kwargs(self, input_ids: torch.Tensor) -> Dict[str, Any]:
+        if self._prefix_cache is None:
+            return {}
+
+        # Only reuse the cache if the prompt tokenizes to the cached prefix followed by at least one more token
+        prefix_ids, past_key_values = self._prefix_cache
+        prefix_length = len(prefix_ids)
+        if input_ids.shape[1] <= prefix_length or input_ids[0, :prefix_length].tolist() != prefix_ids:
+            return {}
+
+        # generate() extends the cache in place, so each call needs its own copy
+        return {"past_key_values": copy.deepcopy(past_key_values)}
+
+    def _get_batched_prefix_cache_inputs(self, input_ids: List[List[int]]) -> Optional[Dict[str, Any]]:
+        # The cached prefix only has a single beam, so it is only reused for greedy decoding
+        if self._prefix_cache is None or self._best_num_beams != 1:
+            return None
+        prefix_ids, past_key_values = self._prefix_cache
+        prefix_length = len(prefix_ids)
+        if not all(len(ids) > prefix_length and ids[:prefix_length] == prefix_ids for ids in input_ids):
+            return None
+
+        # Left-padding would shift the prefix to a different position in each row, so instead the padding goes between
+        # the (shared) prefix and each suffix. The padding is masked out, and the position ids (computed from the
+        # attention mask) continue directly from the prefix, so each row sees exactly its unpadded prompt.
+        suffixes = [ids[prefix_length:] for ids in input_ids]
+        width = max(len(suffix) for suffix in suffixes)
+        padded_ids = [prefix_ids + [self.tokenizer.pad_token_id] * (width - len(s)) + s for s in suffixes]
+        attention_mask = [[1] * prefix_length + [0] * (width - len(s)) + [1] * len(s) for s in suffixes]
+        return {
+            "input_ids": torch.tensor(padded_ids, device=self._generator.device),
+            "attention_mask": torch.tensor(attention_mask, device=self._generator.device),
+            "past_key_values": _expand_past_key_values(past_key_values, len(input_ids)),
+        }
 
     def __call__(
         self, prompt: str, n_completions: int = 1, temperature: Optional[float] = None, **kwargs: Any
     ) -> List[str]:
         input = self.tokenizer(prompt, return_tensors="pt").input_ids.to(self._generator.device)
 
-        if temperature is not None and temperature > 0:
-            outputs = self._generator.generate(
-                input,
-                max_new_tokens=256,
-                num_return_sequences=n_completions,
-                temperature=temperature,
-                do_sample=True,
-            )
-        elif n_completions > 1:
-            outputs = self._generator.generate(
-                input,
-                max_new_tokens=256,
-                num_return_sequences=n_completions,
-                do_sample=True,
-            )
-        else:
-            outputs = self._generator.generate(
-                input,
-                max_new_tokens=256,
-                num_return_sequences=n_completions,
-                do_sample=False,
-            )
+        with torch.inference_mode(), self._tf32_matmuls():
+            if temperature is not None and temperature > 0:
+                outputs = self._generator.generate(
+                    input,
+                    max_new_tokens=256,
+                    num_return_sequences=n_completions,
+                    temperature=temperature,
+                    do_sample=True,
+                )
+            elif n_completions > 1:
+                outputs = self._generator.generate(
+                    input,
+                    max_new_tokens=256,
+                    num_return_sequences=n_completions,
+                    do_sample=True,
+                )
+            else:
+                outputs = self._generator.generate(
+                    input,
+                    max_new_tokens=256,
+                    num_return_sequences=n_completions,
+                    do_sample=False,
+                )
 
         outputs = self.tokenizer.batch_decode(outputs, skip_special_tokens=True, clean_up_tokenization_spaces=False)
 
@@ -64,18 +248,15 @@ class HuggingFaceLlamaLMEngine(LMEngine):
         return outputs
 
     def best(self, prompt: str) -> str:
-        input = self.tokenizer(prompt, return_tensors="pt").input_ids.to(self._generator.device)
+        input = self._tokenize([prompt])["input_ids"]
 
-        # Beam search here doesn't work, since it requires too much GPU memory.
-        outputs = self._generator.generate(
-            input,
-            max_new_tokens=256,
-            do_sample=True,
-            temperature=1.0,
-            num_return_sequences=1,
-            top_k=1,
-            top_p=0.95,
-        )
+        # The cached prefix only has a single beam, so it is only reused for greedy decoding
+        with torch.inference_mode(), self._tf32_matmuls():
+            outputs = self._generator.generate(
+                input,
+                **self._get_best_generate_kwargs(),
+                **(self._get_prefix_cache_kwargs(input) if self._best_num_beams == 1 else {}),
+            )
         outputs = self.tokenizer.batch_decode(outputs, skip_special_tokens=True, clean_up_tokenization_spaces=False)
 
         # We have to return the output without the prompt, but this can be hard to identify.
@@ -85,62 +266,141 @@ class HuggingFaceLlamaLMEngine(LMEngine):
         _, _, output = outputs[0].partition(split)
         return output
 
+    def best_batch(self, prompts: List[str]) -> List[str]:
+        input_ids = self._tokenize_ids(prompts)
+        inputs = self._get_batched_prefix_cache_inputs(input_ids)
+        if inputs is None:
+            inputs = self.tokenizer.pad({"input_ids": input_ids}, return_tensors="pt").to(self._generator.device)
+
+        with torch.inference_mode(), self._tf32_matmuls():
+            outputs = self._generator.generate(**inputs, **self._get_best_generate_kwargs())
+
+        # All of the prompts end at the same position (since they are padded on the left of the prompt or of the
+        # suffix), so we can just slice them off
+        return self.tokenizer.batch_decode(
+            outputs[:, inputs["input_ids"].shape[1] :], skip_special_tokens=True, clean_up_tokenization_spaces=False
+        )
+
 
 @singleton
 class Llama7B(HuggingFaceLlamaLMEngine):
-    def __init__(self, device: Optional[str] = None) -> None:
-        super().__init__("7B", "HUGGINGFACE_LLAMA_WEIGHTS_ROOT", device=device)
+    def __init__(
+        self, device: Optional[str] = None, precision: LlamaPrecision = "fp16", compile_model: bool = False
+    ) -> None:
+        super().__init__(
+            "7B", "HUGGINGFACE_LLAMA_WEIGHTS_ROOT", device=device, precision=precision, compile_model=compile_model
+        )
 
 
 @singleton
 class Llama13B(HuggingFaceLlamaLMEngine):
-    def __init__(self, device: Optional[str] = None) -> None:
-        super().__init__("13B", "HUGGINGFACE_LLAMA_WEIGHTS_ROOT", device=device)
+    def __init__(
+        self, device: Optional[str] = None, precision: LlamaPrecision = "fp16", compile_model: bool = False
+    ) -> None:
+        super().__init__(
+            "13B", "HUGGINGFACE_LLAMA_WEIGHTS_ROOT", device=device, precision=precision, compile_model=compile_model
+        )
 
 
 @singleton
 class Llama30B(HuggingFaceLlamaLMEngine):
-    def __init__(self, device: Optional[str] = None) -> None:
-        super().__init__("30B", "HUGGINGFACE_LLAMA_WEIGHTS_ROOT", device=device)
+    def __init__(
+        self, device: Optional[str] = None, precision: LlamaPrecision = "fp16", compile_model: bool = False
+    ) -> None:
+        super().__init__(
+            "30B", "HUGGINGFACE_LLAMA_WEIGHTS_ROOT", device=device, precision=precision, compile_model=compile_model
+        )
 
 
 @singleton
 class Llama65B(HuggingFaceLlamaLMEngine):
-    def __init__(self, device: Optional[str] = None) -> None:
-        super().__init__("65B", "HUGGINGFACE_LLAMA_WEIGHTS_ROOT", device=device)
+    def __init__(
+        self, device: Optional[str] = None, precision: LlamaPrecision = "fp16", compile_model: bool = False
+    ) -> None:
+        super().__init__(
+            "65B", "HUGGINGFACE_LLAMA_WEIGHTS_ROOT", device=device, precision=precision, compile_model=compile_model
+        )
 
 
 @singleton
 class Alpaca7B(HuggingFaceLlamaLMEngine):
-    def __init__(self, device: Optional[str] = None) -> None:
-        super().__init__("alpaca_7B", "HUGGINGFACE_ALPACA_WEIGHTS_ROOT", device=device)
+    def __init__(
+        self, device: Optional[str] = None, precision: LlamaPrecision = "fp16", compile_model: bool = False
+    ) -> None:
+        super().__init__(
+            "alpaca_7B",
+            "HUGGINGFACE_ALPACA_WEIGHTS_ROOT",
+            device=device,
+            precision=precision,
+            compile_model=compile_model,
+        )
 
 
 @singleton
 class Koala7B(HuggingFaceLlamaLMEngine):
-    def __init__(self, device: Optional[str] = None) -> None:
-        super().__init__("koala_7B", "HUGGINGFACE_KOALA_WEIGHTS_ROOT", device=device)
+    def __init__(
+        self, device: Optional[str] = None, precision: LlamaPrecision = "fp16", compile_model: bool = False
+    ) -> None:
+        super().__init__(
+            "koala_7B",
+            "HUGGINGFACE_KOALA_WEIGHTS_ROOT",
+            device=device,
+            precision=precision,
+            compile_model=compile_model,
+        )
 
 
 @singleton
 class Koala13B_V1(HuggingFaceLlamaLMEngine):
-    def __init__(self, device: Optional[str] = None) -> None:
-        super().__init__("koala_13B_v1", "HUGGINGFACE_KOALA_WEIGHTS_ROOT", device=device)
+    def __init__(
+        self, device: Optional[str] = None, precision: LlamaPrecision = "fp16", compile_model: bool = False
+    ) -> None:
+        super().__init__(
+            "koala_13B_v1",
+            "HUGGINGFACE_KOALA_WEIGHTS_ROOT",
+            device=device,
+            precision=precision,
+            compile_model=compile_model,
+        )
 
 
 @singleton
 class Koala13B_V2(HuggingFaceLlamaLMEngine):
-    def __init__(self, device: Optional[str] = None) -> None:
-        super().__init__("koala_13B_v2", "HUGGINGFACE_KOALA_WEIGHTS_ROOT", device=device)
+    def __init__(
+        self, device: Optional[str] = None, precision: LlamaPrecision = "fp16", compile_model: bool = False
+    ) -> None:
+        super().__init__(
+            "koala_13B_v2",
+            "HUGGINGFACE_KOALA_WEIGHTS_ROOT",
+            device=device,
+            precision=precision,
+            compile_model=compile_model,
+        )
 
 
 @singleton
 class Vicuna_7B(HuggingFaceLlamaLMEngine):
-    def __init__(self, device: Optional[str] = None) -> None:
-        super().__init__("vicuna_7B", "HUGGINGFACE_VICUNA_WEIGHTS_ROOT", device=device)
+    def __init__(
+        self, device: Optional[str] = None, precision: LlamaPrecision = "fp16", compile_model: bool = False
+    ) -> None:
+        super().__init__(
+            "vicuna_7B",
+            "HUGGINGFACE_VICUNA_WEIGHTS_ROOT",
+            device=device,
+            precision=precision,
+            compile_model=compile_model,
+        )
 
 
 @singleton
 class Vicuna_13B(HuggingFaceLlamaLMEngine):
-    def __init__(self, device: Optional[str] = None) -> None:
-        super().__init__("vicuna_13B", "HUGGINGFACE_VICUNA_WEIGHTS_ROOT", device=device)
\ No newline at end of file
+    def __init__(
+        self, device: Optional[str] = None, precision: LlamaPrecision = "fp16", compile_model: bool = False
+    ) -> None:
+        super().__init__(
+            "vicuna_13B",
+            "HUGGINGFACE_VICUNA_WEIGHTS_ROOT",
+            device=device,
+            precision=precision,
+            compile_model=compile_model,
+        )
@@ -18,11 +18,12 @@ class HuggingFaceLocalLMEngine(LMEngine):
             framework="pt",
             device=pipeline_device if pipeline_device != "cpu" else None,
         )
+        self._best_max_new_tokens = 256
+        self._best_num_beams = 16
 
     def __call__(
         self, prompt: str, n_completions: int = 1, temperature: Optional[float] = None, **kwargs: Any
     ) -> List[str]:
-
         if temperature is not None and temperature > 0:
             outputs = self._generator(
                 prompt,
@@ -56,8 +57,18 @@ class HuggingFaceLocalLMEngine(LMEngine):
 
         return outputs
 
+    def configure_best(self, max_new_tokens: int, num_beams: int) -> None:
+        self._best_max_new_tokens = max_new_tokens
+        self._best_num_beams = num_beams
+
     def best(self, prompt: str) -> str:
-        outputs = self._generator(prompt, max_new_tokens=256, min_new_tokens=10, num_beams=16, return_full_text=False)
+        outputs = self._generator(
+            prompt,
+            max_new_tokens=self._best_max_new_tokens,
+            min_new_tokens=min(10, self._best_max_new_tokens),
+            num_beams=self._best_num_beams,
+            return_full_text=False,
+        )
         outputs = [g["generated_text"].strip() for g in outputs]  # type: ignore
 
         return outputs[0]
@@ -69,11 +80,12 @@ class HuggingFaceLocalSummaryEngine(LMEngine):
         self._generator = pipeline(
             "summarization", model=model, framework="pt", device=pipeline_device if pipeline_device != "cpu" else None
         )
+        self._best_max_new_tokens = 256
+        self._best_num_beams = 16
 
     def __call__(
         self, prompt: str, n_completions: int = 1, temperature: Optional[float] = None, **kwargs: Any
     ) -> List[str]:
-
         if temperature is not None and temperature > 0:
             outputs = self._generator(
                 prompt,
@@ -98,8 +110,18 @@ class HuggingFaceLocalSummaryEngine(LMEngine):
 
         return outputs
 
+    def configure_best(self, max_new_tokens: int, num_beams: int) -> None:
+        self._best_max_new_tokens = max_new_tokens
+        self._best_num_beams = num_beams
+
     def best(self, prompt: str) -> str:
-        outputs = self._generator(prompt, max_new_tokens=256, min_new_tokens=10, num_beams=16, return_full_text=False)
+        outputs = self._generator(
+            prompt,
+            max_new_tokens=self._best_max_new_tokens,
+            min_new_tokens=min(10, self._best_max_new_tokens),
+            num_beams=self._best_num_beams,
+            return_full_text=False,
+        )
         outputs = [g["summary_text"].strip() for g in outputs]  # type: ignore
 
         return outputs[0]
@@ -115,7 +137,6 @@ class StopOnTokens(StoppingCriteria):
 
 
 class StableLMChatEngine(LMEngine):
-
     SYSTEM_PROMPT = """<|SYSTEM|># StableLM Tuned (Alpha version)
 - StableLM is a helpful and harmless open-source AI language model developed by StabilityAI.
 - StableLM is excited to be able to help the user, but will refuse to do anything that could be considered harmful to the user.
@@ -128,6 +149,8 @@ class StableLMChatEngine(LMEngine):
         self._model = AutoModelForCausalLM.from_pretrained(model)
         self._model.half().to(device)
         self._device = device
+        self._best_max_new_tokens = 256
+        self._best_num_beams = 16
 
     def _decode_tokens(self, tokens: torch.Tensor) -> str:
         output = self._tokenizer.decode(tokens).strip()
@@ -144,7 +167,6 @@ class StableLMChatEngine(LMEngine):
     def __call__(
         self, prompt: str, n_completions: int = 1, temperature: Optional[float] = None, **kwargs: Any
     ) -> List[str]:
-
         # Filter the prompt (one-off experiment)
         prompt = prompt.replace("Summary:", "\nComplete the following sentence according to the task above:\nSummary: ")
         prompt = f"{StableLMChatEngine.SYSTEM_PROMPT}<|USER|>{prompt}<|ASSISTANT|>"
@@ -173,19 +195,21 @@ class StableLMChatEngine(LMEngine):
         outputs = [self._decode_tokens(t) for t in tokens]  # type: ignore
         return outputs
 
-    def best(self, prompt: str) -> str:
+    def configure_best(self, max_new_tokens: int, num_beams: int) -> None:
+        self._best_max_new_tokens = max_new_tokens
+        self._best_num_beams = num_beams
 
+    def best(self, prompt: str) -> str:
         with torch.no_grad():
-
             pre_input_prompt = prompt.replace("Summary:", "\nComplete the following sentence:\n")
             lm_prompt = f"{StableLMChatEngine.SYSTEM_PROMPT}<|USER|>{pre_input_prompt}<|ASSISTANT|>"
             inputs = self._tokenizer(lm_prompt, return_tensors="pt").to(self._device)
 
             tokens = self._model.generate(
                 **inputs,
-                max_new_tokens=256,
-                min_new_tokens=5,
-                num_beams=16,
+                max_new_tokens=self._best_max_new_tokens,
+                min_new_tokens=min(5, self._best_max_new_tokens),
+                num_beams=self._best_num_beams,
                 do_sample=False,
                 stopping_criteria=StoppingCriteriaList([StopOnTokens()]),
             )
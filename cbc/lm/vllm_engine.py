@@ -0,0 +1,145 @@
+import os
+from typing import Any, Dict, List, Optional
+
+try:
+    from vllm import LLM, SamplingParams
+except ImportError:
+    LLM = None
+    SamplingParams = None
+
+try:
+    from vllm.distributed.parallel_state import destroy_distributed_environment, destroy_model_parallel
+except ImportError:
+    destroy_distributed_environment = None
+    destroy_model_parallel = None
+
+from cbc.lm.base import LMEngine
+from cbc.lm.huggingface_llama_engine import LlamaPrecision
+from cbc.utils.python import singleton
+
+_VLLM_DTYPES: Dict[str, str] = {
+    "fp32": "float32",
+    "fp16": "float16",
+    "bf16": "bfloat16",
+}
+
+
+class VLLMLlamaLMEngine(LMEngine):
+    def __init__(self, model: str, weight_root: str, device: Optional[str] = None, precision: LlamaPrecision = "fp16"):
+        if LLM is None or SamplingParams is None:
+            raise ImportError("Please install vllm to use this LM engine.")
+        if precision not in _VLLM_DTYPES:
+            raise ValueError(f"Invalid precision: {precision}, should be one of {list(_VLLM_DTYPES.keys())}")
+
+        # vLLM places the model on the current CUDA device itself
+        self._device = device
+        # Continuous batching runs every prompt passed to generate() at once, and prefix caching reuses the KV cache of
+        # the prompt template shared across all of the samples. The maximum context length is left for vLLM to read from
+        # the model config (2048 tokens for LLaMA-1 based models).
+        self._llm = LLM(
+            model=f"{os.environ.get(weight_root, '')}{model}",
+            dtype=_VLLM_DTYPES[precision],
+            enable_prefix_caching=True,
+        )
+        self._best_max_new_tokens = 256
+
+    def __call__(
+        self, prompt: str, n_completions: int = 1, temperature: Optional[float] = None, **kwargs: Any
+    ) -> List[str]:
+        if temperature is None:
+            temperature = 1.0 if n_completions > 1 else 0.0
+
+        outputs = self._llm.generate(
+            [prompt], SamplingParams(n=n_completions, temperature=temperature, max_tokens=256), use_tqdm=False
+        )
+        return [output.text for output in outputs[0].outputs]
+
+    def configure_best(self, max_new_tokens: int, num_beams: int) -> None:
+        # Beam search is not part of vLLM's sampling API (in recent versions), so best() is always greedy
+        if num_beams != 1:
+            raise ValueError(f"Invalid number of beams: {num_beams}, vLLM engines only support greedy decoding")
+        self._best_max_new_tokens = max_new_tokens
+
+    def best(self, prompt: str) -> str:
+        return self.best_batch([prompt])[0]
+
+    def best_batch(self, prompts: List[str]) -> List[str]:
+        outputs = self._llm.generate(
+            prompts, SamplingParams(temperature=0.0, max_tokens=self._best_max_new_tokens), use_tqdm=False
+        )
+        return [output.outputs[0].text for output in outputs]
+
+    def release(self) -> None:
+        # vLLM reserves most of the GPU memory for its KV cache when the engine is created, and its workers (and the
+        # distributed state) keep references to it, so dropping the LLM alone does not give the memory back
+        engine = self._llm.llm_engine
+        if hasattr(engine, "engine_core"):
+            # The V1 engine runs the model in a separate process
+            engine.engine_core.shutdown()
+        elif hasattr(engine, "model_executor"):
+            engine.model_executor.shutdown()
+            del engine.model_executor
+        if destroy_model_parallel is not None and destroy_distributed_environment is not None:
+            destroy_model_parallel()
+            destroy_distributed_environment()
+        del self._llm
+
+
+@singleton
+class VLLMLlama7B(VLLMLlamaLMEngine):
+    def __init__(self, device: Optional[str] = None, precision: LlamaPrecision = "fp16") -> None:
+        super().__init__("7B", "HUGGINGFACE_LLAMA_WEIGHTS_ROOT", device=device, precision=precision)
+
+
+@singleton
+class VLLMLlama13B(VLLMLlamaLMEngine):
+    def __init__(self, device: Optional[str] = None, precision: LlamaPrecision = "fp16") -> None:
+        super().__init__("13B", "HUGGINGFACE_LLAMA_WEIGHTS_ROOT", device=device, precision=precision)
+
+
+@singleton
+class VLLMLlama30B(VLLMLlamaLMEngine):
+    def __init__(self, device: Optional[str] = None, precision: LlamaPrecision = "fp16") -> None:
+        super().__init__("30B", "HUGGINGFACE_LLAMA_WEIGHTS_ROOT", device=device, precision=precision)
+
+
+@singleton
+class VLLMLlama65B(VLLMLlamaLMEngine):
+    def __init__(self, device: Optional[str] = None, precision: LlamaPrecision = "fp16") -> None:
+        super().__init__("65B", "HUGGINGFACE_LLAMA_WEIGHTS_ROOT", device=device, precision=precision)
+
+
+@singleton
+class VLLMAlpaca7B(VLLMLlamaLMEngine):
+    def __init__(self, device: Optional[str] = None, precision: LlamaPrecision = "fp16") -> None:
+        super().__init__("alpaca_7B", "HUGGINGFACE_ALPACA_WEIGHTS_ROOT", device=device, precision=precision)
+
+
+@singleton
+class VLLMKoala7B(VLLMLlamaLMEngine):
+    def __init__(self, device: Optional[str] = None, precision: LlamaPrecision = "fp16") -> None:
+        super().__init__("koala_7B", "HUGGINGFACE_KOALA_WEIGHTS_ROOT", device=device, precision=precision)
+
+
+@singleton
+class VLLMKoala13B_V1(VLLMLlamaLMEngine):
+    def __init__(self, device: Optional[str] = None, precision: LlamaPrecision = "fp16") -> None:
+        super().__init__("koala_13B_v1", "HUGGINGFACE_KOALA_WEIGHTS_ROOT", device=device, precision=precision)
+
+
+@singleton
+class VLLMKoala13B_V2(VLLMLlamaLMEngine):
+    def __init__(self, device: Optional[str] = None, precision: LlamaPrecision = "fp16") -> None:
+        super().__init__("koala_13B_v2", "HUGGINGFACE_KOALA_WEIGHTS_ROOT", device=device, precision=precision)
+
+
+@singleton
+class VLLMVicuna_7B(VLLMLlamaLMEngine):
+    def __init__(self, device: Optional[str] = None, precision: LlamaPrecision = "fp16") -> None:
+        super().__init__("vicuna_7B", "HUGGINGFACE_VICUNA_WEIGHTS_ROOT", device=device, precision=precision)
+
+
+@singleton
+class VLLMVicuna_13B(VLLMLlamaLMEngine):
+    def __init__(self, device: Optional[str] = None, precision: LlamaPrecision = "fp16") -> None:
+        super().__init__("vicuna_13B", "HUGGINGFACE_VICUNA_WEIGHTS_ROOT", device=device, precision=precision)
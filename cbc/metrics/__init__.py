@@ -1,5 +1,10 @@
 from .base import compute_and_add_base_metrics, compute_and_add_mauve_score  # noqa: F401
-from .clip_score import compute_and_add_clip_recall  # noqa: F401
+from .clip_score import (  # noqa: F401
+    compute_and_add_clip_recall,
+    load_image_feature_cache,
+    release_clip_model,
+    save_image_feature_cache,
+)
 from .content_score import compute_and_add_content_recall  # noqa: F401
 from .object_hallucinations import compute_and_add_object_hallucinations  # noqa: F401
 from .self_bleu import compute_and_add_self_bleu  # noqa: F401
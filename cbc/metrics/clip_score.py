@@ -1,4 +1,6 @@
+import contextlib
 import os
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any, Dict, List, Optional, Tuple
 
 import numpy as np
@@ -11,8 +13,14 @@ _CLIP_MODEL = None
 _CLIP_PREPROCESS = None
 _CLIP_TOKENIZER = None
 
+_CLIP_MODEL_NAME = "ViT-g-14"
+_CLIP_PRETRAINED = "laion2b_s12b_b42k"
+
 _CLIP_BACKOFF_CHARACTER_STEPS = 20
 
+# Image features keyed on (encoder, image path)
+ImageFeatureCache = Dict[Tuple[str, str], np.ndarray]
+
 
 def clip_model() -> Tuple[Any, Any, Any, str]:
     global _CLIP_MODEL
@@ -21,29 +29,79 @@ def clip_model() -> Tuple[Any, Any, Any, str]:
     if _CLIP_MODEL is None:
         # _CLIP_MODEL, _CLIP_PREPROCESS = clip.load("ViT-L/14", device="cuda:0" if torch.cuda.is_available() else "cpu")
         _CLIP_MODEL, _, _CLIP_PREPROCESS = open_clip.create_model_and_transforms(
-            "ViT-g-14", pretrained="laion2b_s12b_b42k", device="cuda:0"
+            _CLIP_MODEL_NAME, pretrained=_CLIP_PRETRAINED, device="cuda:0"
         )
-        _CLIP_TOKENIZER = open_clip.get_tokenizer("ViT-g-14")
+        _CLIP_TOKENIZER = open_clip.get_tokenizer(_CLIP_MODEL_NAME)
     return _CLIP_MODEL, _CLIP_PREPROCESS, _CLIP_TOKENIZER, "cuda:0" if torch.cuda.is_available() else "cpu"
 
 
-def _get_feature(media_path: str) -> torch.Tensor:
-    model, preprocess, tokenizer, device = clip_model()
-    image = preprocess(Image.open(media_path)).unsqueeze(0).to(device)
-    with torch.no_grad():
-        image_features = model.encode_image(image)
-        image_features = image_features / image_features.norm(dim=-1, keepdim=True)
-    return image_features.reshape(-1)
+def release_clip_model() -> None:
+    # Drop the cached model, so that its GPU memory can be freed. The next call to clip_model() loads it again.
+    global _CLIP_MODEL
+    global _CLIP_PREPROCESS
+    global _CLIP_TOKENIZER
+    _CLIP_MODEL = None
+    _CLIP_PREPROCESS = None
+    _CLIP_TOKENIZER = None
+
+
+def load_image_feature_cache(path: str) -> ImageFeatureCache:
+    if not os.path.exists(path):
+        return {}
+    data = np.load(path)
+    return {
+        (str(encoder), str(media_path)): feature
+        for encoder, media_path, feature in zip(data["encoders"], data["paths"], data["features"])
+    }
+
+
+def save_image_feature_cache(path: str, feature_cache: ImageFeatureCache) -> None:
+    if not feature_cache:
+        return
+    keys = list(feature_cache.keys())
+    np.savez(
+        path,
+        encoders=np.array([encoder for encoder, _ in keys]),
+        paths=np.array([media_path for _, media_path in keys]),
+        features=np.stack([feature_cache[k] for k in keys]),
+    )
+
+
+def _encode_images(media_paths: List[str], max_workers: int = 8, half_precision: bool = False) -> torch.Tensor:
+    model, preprocess, _, device = clip_model()
+    # Decode + preprocess the images in threads, then run the whole batch through the encoder at once
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        images = torch.stack(list(executor.map(lambda path: preprocess(Image.open(path)), media_paths))).to(device)
+    with torch.inference_mode():
+        with _autocast(device, half_precision):
+            image_features = model.encode_image(images).float()
+        image_features /= image_features.norm(dim=-1, keepdim=True)
+    return image_features
 
 
 def _get_image_feature_db(
-    samples: List[Dict[str, Any]], image_path_key: str, image_root: Optional[str] = None
+    samples: List[Dict[str, Any]],
+    image_path_key: str,
+    image_root: Optional[str] = None,
+    feature_cache: Optional[ImageFeatureCache] = None,
+    batch_size: int = 64,
+    half_precision: bool = False,
 ) -> torch.Tensor:
-    features = []
-    for sample in tqdm.tqdm(samples):
-        media_path = os.path.join(image_root or "", sample[image_path_key])
-        features.append(_get_feature(media_path))
-    return torch.stack(features).to("cpu" if not torch.cuda.is_available() else "cuda:0")
+    feature_cache = {} if feature_cache is None else feature_cache
+    # Features computed in half precision differ slightly, so they are cached separately
+    encoder = f"{_CLIP_MODEL_NAME}/{_CLIP_PRETRAINED}{'/fp16' if half_precision else ''}"
+    media_paths = [os.path.join(image_root or "", sample[image_path_key]) for sample in samples]
+
+    # Only run the image encoder for images which haven't been seen before
+    uncached_paths = [p for p in dict.fromkeys(media_paths) if (encoder, p) not in feature_cache]
+    for batch_start in tqdm.tqdm(range(0, len(uncached_paths), batch_size)):
+        batch_paths = uncached_paths[batch_start : batch_start + batch_size]
+        batch_features = _encode_images(batch_paths, half_precision=half_precision).cpu().numpy()
+        for media_path, feature in zip(batch_paths, batch_features):
+            feature_cache[(encoder, media_path)] = feature
+
+    features = np.stack([feature_cache[(encoder, p)] for p in media_paths])
+    return torch.from_numpy(features).to("cpu" if not torch.cuda.is_available() else "cuda:0")
 
 
 def _get_text_feature(samples: List[str], char_limit: int = 300) -> torch.Tensor:
@@ -64,10 +122,54 @@ def _get_text_feature(samples: List[str], char_limit: int = 300) -> torch.Tensor
     return text_features
 
 
+def _tokenize(texts: List[str], char_limit: int = 300) -> torch.Tensor:
+    # Tokenize each of the texts separately, so that the character limit only backs off for the texts which need it
+    _, _, tokenizer, _ = clip_model()
+    tokens = []
+    for text in texts:
+        text_char_limit = char_limit
+        while True:
+            try:
+                tokens.append(tokenizer([text[:text_char_limit]]))
+                break
+            except RuntimeError:
+                # Back off the character limit
+                if text_char_limit < _CLIP_BACKOFF_CHARACTER_STEPS:
+                    raise RuntimeError("Could not tokenize text -- too long?")
+                text_char_limit -= _CLIP_BACKOFF_CHARACTER_STEPS
+    return torch.cat(tokens)
+
+
+def _compute_ranks(
+    indices: List[int], feature_db: torch.Tensor, texts: List[str], batch_size: int = 64, half_precision: bool = False
+) -> np.ndarray:
+    # The rank of each image (indices[i]) among all of the images in the dataset for its text (texts[i]), computed with
+    # one similarity matmul per batch of texts
+    model, _, _, device = clip_model()
+    ranks = []
+    for batch_start in range(0, len(texts), batch_size):
+        batch_indices = torch.tensor(indices[batch_start : batch_start + batch_size], device=feature_db.device)
+        text = _tokenize(texts[batch_start : batch_start + batch_size]).to(device)
+        with torch.inference_mode():
+            with _autocast(device, half_precision):
+                text_features = model.encode_text(text).float()
+            text_features /= text_features.norm(dim=-1, keepdim=True)
+            similarity_scores = feature_db.float() @ text_features.T
+            target_scores = similarity_scores[batch_indices, torch.arange(len(batch_indices), device=feature_db.device)]
+            ranks.append(((similarity_scores > target_scores).sum(dim=0) + 1).cpu().numpy())
+    return np.concatenate(ranks) if ranks else np.zeros(0, dtype=np.int64)
+
+
+def _autocast(device: str, half_precision: bool) -> Any:
+    # Half precision is faster, but can change the rank of near-tied images, so it is opt-in (and only used on the GPU)
+    if half_precision and device.startswith("cuda"):
+        return torch.autocast("cuda", dtype=torch.float16)
+    return contextlib.nullcontext()
+
+
 def _get_text_features(
     candidates: List[str], references: List[str], baselines: List[str], char_limit: int = 300
 ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
-
     return _get_text_feature(candidates), _get_text_feature(references), _get_text_feature(baselines)
 
 
@@ -109,46 +211,28 @@ def compute_clips(
 
 
 def compute_and_add_clip_recall(
-    samples: List[Dict[str, Any]], image_path_key: str, image_root: Optional[str] = None
+    samples: List[Dict[str, Any]],
+    image_path_key: str,
+    image_root: Optional[str] = None,
+    feature_cache: Optional[ImageFeatureCache] = None,
+    batch_size: int = 64,
+    half_precision: bool = False,
 ) -> List[Dict[str, Any]]:
-
-    feature_db = _get_image_feature_db(samples, image_path_key, image_root)
-
-    for index, sample in enumerate(tqdm.tqdm(samples)):
-
-        if "candidate_summary" in sample:
-            candidate_ranks = _compute_rank(index, feature_db, sample["candidate_summary"])
-            sample["scores"]["candidate_summary_clip_recall_rank"] = float(np.mean(candidate_ranks))
-            sample["scores"]["candidate_summary_clip_recall_mrr"] = float(np.mean(1 / candidate_ranks))
-            sample["scores"]["candidate_summary_clip_recall_at_1"] = float(np.mean(candidate_ranks <= 1))
-            sample["scores"]["candidate_summary_clip_recall_at_5"] = float(
-                np.mean(candidate_ranks <= 5)  # noqa: PLR2004
-            )
-            sample["scores"]["candidate_summary_clip_recall_at_10"] = float(
-                np.mean(candidate_ranks <= 10)  # noqa: PLR2004
-            )
-            sample["scores"]["candidate_summary_clip_recall_max_rank"] = float(np.amax(candidate_ranks))
-
-        if "reference_summary" in sample:
-            reference_ranks = _compute_rank(index, feature_db, sample["reference_summary"])
-            sample["scores"]["reference_summary_clip_recall_rank"] = float(np.mean(reference_ranks))
-            sample["scores"]["reference_summary_clip_recall_mrr"] = float(np.mean(1 / reference_ranks))
-            sample["scores"]["reference_summary_clip_recall_at_1"] = float(np.mean(reference_ranks <= 1))
-            sample["scores"]["reference_summary_clip_recall_at_5"] = float(
-                np.mean(reference_ranks <= 5)  # noqa: PLR2004
-            )
-            sample["scores"]["reference_summary_clip_recall_at_10"] = float(
-                np.mean(reference_ranks <= 10)  # noqa: PLR2004
-            )
-            sample["scores"]["reference_summary_clip_recall_max_rank"] = float(np.amax(reference_ranks))
-
-        if "baseline" in sample:
-            baseline_ranks = _compute_rank(index, feature_db, sample["baseline"])
-            sample["scores"]["baseline_clip_recall_rank"] = float(np.mean(baseline_ranks))
-            sample["scores"]["baseline_clip_recall_mrr"] = float(np.mean(1 / baseline_ranks))
-            sample["scores"]["baseline_clip_recall_at_1"] = float(np.mean(baseline_ranks <= 1))
-            sample["scores"]["baseline_clip_recall_at_5"] = float(np.mean(baseline_ranks <= 5))  # noqa: PLR2004
-            sample["scores"]["baseline_clip_recall_at_10"] = float(np.mean(baseline_ranks <= 10))  # noqa: PLR2004
-            sample["scores"]["baseline_clip_recall_max_rank"] = float(np.amax(baseline_ranks))
+    feature_db = _get_image_feature_db(
+        samples, image_path_key, image_root, feature_cache, batch_size=batch_size, half_precision=half_precision
+    )
+
+    for key in ("candidate_summary", "reference_summary", "baseline"):
+        indices = [index for index, sample in enumerate(samples) if key in sample]
+        texts = [samples[index][key] for index in indices]
+        ranks = _compute_ranks(indices, feature_db, texts, batch_size=batch_size, half_precision=half_precision)
+        for index, rank in zip(indices, ranks):
+            sample = samples[index]
+            sample["scores"][f"{key}_clip_recall_rank"] = float(rank)
+            sample["scores"][f"{key}_clip_recall_mrr"] = float(1 / rank)
+            sample["scores"][f"{key}_clip_recall_at_1"] = float(rank <= 1)
+            sample["scores"][f"{key}_clip_recall_at_5"] = float(rank <= 5)  # noqa: PLR2004
+            sample["scores"][f"{key}_clip_recall_at_10"] = float(rank <= 10)  # noqa: PLR2004
+            sample["scores"][f"{key}_clip_recall_max_rank"] = float(rank)
 
     return samples
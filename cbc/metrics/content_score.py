@@ -3,6 +3,8 @@ from typing import Any, Dict, List, Tuple
 import spacy
 import tqdm
 
+from cbc.utils.python import parallel_imap
+
 _NLP = None
 
 
@@ -78,59 +80,44 @@ def fuzzy_overlap(query: str, targets: List[str], POS: Tuple[str, ...] = ("NOUN"
     return float(sum(metric) / (len(metric) + 1e-8))
 
 
-def compute_and_add_content_recall(samples: List[Dict[str, Any]], reference_key: str) -> List[Dict[str, Any]]:
+def _content_recall_scores(summaries_and_references: Tuple[Dict[str, str], List[str]]) -> Dict[str, float]:
+    summaries, references = summaries_and_references
+
+    scores = {}
+    for summary_key, summary in summaries.items():
+        # Exact Recall
+        scores[f"{summary_key}_noun_recall"] = exact_overlap(summary, references, POS=("NOUN", "PROPN"))
+        scores[f"{summary_key}_verb_recall"] = exact_overlap(summary, references, POS=("VERB",))
+        # Fuzzy Recall
+        scores[f"{summary_key}_noun_fuzzy_recall"] = fuzzy_overlap(summary, references, POS=("NOUN", "PROPN"))
+        scores[f"{summary_key}_verb_fuzzy_recall"] = fuzzy_overlap(summary, references, POS=("VERB",))
+
+    return scores
+
 
-    for sample in tqdm.tqdm(samples):
+def compute_and_add_content_recall(
+    samples: List[Dict[str, Any]], reference_key: str, num_workers: int = 1
+) -> List[Dict[str, Any]]:
+    for sample in samples:
         if "scores" not in sample:
             sample["scores"] = {}
         if "content_recall" not in sample["scores"]:
             sample["scores"]["content_recall"] = {}
 
-        if "baseline" in sample:
-            # Exact Recall
-            sample["scores"]["content_recall"]["baseline_noun_recall"] = exact_overlap(
-                sample["baseline"], sample[reference_key], POS=("NOUN", "PROPN")
-            )
-            sample["scores"]["content_recall"]["baseline_verb_recall"] = exact_overlap(
-                sample["baseline"], sample[reference_key], POS=("VERB",)
-            )
-            # Fuzzy Recall
-            sample["scores"]["content_recall"]["baseline_noun_fuzzy_recall"] = fuzzy_overlap(
-                sample["baseline"], sample[reference_key], POS=("NOUN", "PROPN")
-            )
-            sample["scores"]["content_recall"]["baseline_verb_fuzzy_recall"] = fuzzy_overlap(
-                sample["baseline"], sample[reference_key], POS=("VERB",)
-            )
-
-        if "candidate_summary" in sample:
-            # Exact Recall
-            sample["scores"]["content_recall"]["candidate_summary_noun_recall"] = exact_overlap(
-                sample["candidate_summary"], sample[reference_key], POS=("NOUN", "PROPN")
-            )
-            sample["scores"]["content_recall"]["candidate_summary_verb_recall"] = exact_overlap(
-                sample["candidate_summary"], sample[reference_key], POS=("VERB",)
-            )
-            # Fuzzy Recall
-            sample["scores"]["content_recall"]["candidate_summary_noun_fuzzy_recall"] = fuzzy_overlap(
-                sample["candidate_summary"], sample[reference_key], POS=("NOUN", "PROPN")
-            )
-            sample["scores"]["content_recall"]["candidate_summary_verb_fuzzy_recall"] = fuzzy_overlap(
-                sample["candidate_summary"], sample[reference_key], POS=("VERB",)
+    # Each worker loads its own copy of the spacy model once, when it starts
+    scores = parallel_imap(
+        _content_recall_scores,
+        [
+            (
+                {k: sample[k] for k in ("baseline", "candidate_summary", "reference_summary") if k in sample},
+                sample[reference_key],
             )
+            for sample in samples
+        ],
+        num_workers=num_workers,
+        initializer=get_nlp,
+    )
+    for sample, score in zip(samples, tqdm.tqdm(scores, total=len(samples))):
+        sample["scores"]["content_recall"].update(score)
 
-        if "reference_summary" in sample:
-            # Exact Recall
-            sample["scores"]["content_recall"]["reference_summary_noun_recall"] = exact_overlap(
-                sample["reference_summary"], sample[reference_key], POS=("NOUN", "PROPN")
-            )
-            sample["scores"]["content_recall"]["reference_summary_verb_recall"] = exact_overlap(
-                sample["reference_summary"], sample[reference_key], POS=("VERB",)
-            )
-            # Fuzzy Recall
-            sample["scores"]["content_recall"]["reference_summary_noun_fuzzy_recall"] = fuzzy_overlap(
-                sample["reference_summary"], sample[reference_key], POS=("NOUN", "PROPN")
-            )
-            sample["scores"]["content_recall"]["reference_summary_verb_fuzzy_recall"] = fuzzy_overlap(
-                sample["reference_summary"], sample[reference_key], POS=("VERB",)
-            )
     return samples
@@ -1,10 +1,12 @@
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Tuple
 
 import numpy as np
 import tqdm
 from vdtk.metrics.bleu.bleu import Bleu
 from vdtk.metrics.tokenizer.ptbtokenizer import PTBTokenizer
 
+from cbc.utils.python import parallel_imap
+
 
 def self_bleu(candidates: List[str]) -> float:
     tokenizer = PTBTokenizer()
@@ -27,16 +29,25 @@ def self_bleu(candidates: List[str]) -> float:
     return float(np.mean(list(c_b_full[0].values())))
 
 
+def _self_bleu_scores(candidates_and_references: Tuple[List[str], List[str]]) -> Dict[str, float]:
+    candidates, references = candidates_and_references
+    return {"candidates": self_bleu(candidates), "references": self_bleu(references)}
+
+
 def compute_and_add_self_bleu(
-    samples: List[Dict[str, Any]], candidate_key: str, reference_key: str
+    samples: List[Dict[str, Any]], candidate_key: str, reference_key: str, num_workers: int = 1
 ) -> List[Dict[str, Any]]:
-
-    for sample in tqdm.tqdm(samples):
+    for sample in samples:
         if "scores" not in sample:
             sample["scores"] = {}
-        if "self_bleu" not in sample["scores"]:
-            sample["scores"]["self_bleu"] = {}
-            sample["scores"]["self_bleu"]["candidates"] = self_bleu(sample[candidate_key])
-            sample["scores"]["self_bleu"]["references"] = self_bleu(sample[reference_key])
+
+    indices = [i for i, sample in enumerate(samples) if "self_bleu" not in sample["scores"]]
+    scores = parallel_imap(
+        _self_bleu_scores,
+        [(samples[i][candidate_key], samples[i][reference_key]) for i in indices],
+        num_workers=num_workers,
+    )
+    for i, score in zip(indices, tqdm.tqdm(scores, total=len(indices))):
+        samples[i]["scores"]["self_bleu"] = score
 
     return samples
@@ -1,5 +1,5 @@
 from abc import ABC, abstractmethod
-from typing import Dict, Optional
+from typing import Dict, List, Optional
 
 from PIL.Image import Image
 
@@ -12,6 +12,10 @@ class ImagePlugin(ABC):
     def __call__(self, raw_image: Image) -> Dict[str, str]:
         raise NotImplementedError()
 
+    def batch(self, raw_images: List[Image]) -> List[Dict[str, str]]:
+        # Plugins which can process several images at once should override this
+        return [self(raw_image) for raw_image in raw_images]
+
 
 class TestPlugin(ImagePlugin):
     def __call__(self, raw_image: Image) -> Dict[str, str]:
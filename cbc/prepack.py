@@ -0,0 +1,41 @@
+import os
+from typing import Any, Dict, List, Optional
+
+import click
+import orjson
+import tqdm
+
+from cbc.utils.images import pack_images
+
+
+@click.command()
+@click.argument("dataset_json_path", type=click.Path(exists=True))
+@click.option("--output-prefix", type=str, default="images", help="Writes <prefix>.bin and <prefix>.idx.")
+@click.option("--image-path-key", type=str, default="image_path", help="The key to use for the image path.")
+@click.option("--image-root-dir", type=str, default=None, help="The root directory for the images.")
+@click.option(
+    "--resolution",
+    type=int,
+    default=None,
+    help="Resize the images to this (square) resolution before packing. By default, images are stored at full size.",
+)
+def prepack_images(
+    dataset_json_path: str,
+    output_prefix: str,
+    image_path_key: str,
+    image_root_dir: Optional[str] = None,
+    resolution: Optional[int] = None,
+) -> None:
+    """
+    Decode the images of a dataset once, so that evaluate-dataset --packed-images can skip decoding on every run.
+    """
+    print(f"Loading dataset from {dataset_json_path}...")
+    with open(dataset_json_path, "rb") as f:
+        samples: List[Dict[str, Any]] = orjson.loads(f.read())
+        if isinstance(samples, dict):
+            samples = samples["samples"]  # type: ignore
+
+    print(f"Packing images to {output_prefix}.bin...")
+    image_paths = [os.path.join(image_root_dir or ".", sample[image_path_key]) for sample in samples]
+    num_images = pack_images(tqdm.tqdm(image_paths), output_prefix, resolution=resolution)
+    print(f"Packed {num_images} images.")
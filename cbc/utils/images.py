@@ -0,0 +1,54 @@
+import os
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+import numpy as np
+import orjson
+from PIL import Image
+
+
+def pack_images(image_paths: Iterable[str], output_prefix: str, resolution: Optional[int] = None) -> int:
+    """Decode a set of images once, and write the raw RGB pixels to <output_prefix>.bin (with an index in
+    <output_prefix>.idx), so that later runs can skip decoding entirely. Returns the number of packed images."""
+    index: Dict[str, Tuple[int, int, int]] = {}
+    offset = 0
+    with open(f"{output_prefix}.bin", "wb") as f:
+        for image_path in image_paths:
+            key = os.path.normpath(image_path)
+            if key in index:
+                continue
+            image = Image.open(image_path).convert("RGB")
+            if resolution is not None:
+                image = image.resize((resolution, resolution), resample=Image.BICUBIC)
+            pixels = np.asarray(image, dtype=np.uint8)
+            f.write(pixels.tobytes())
+            index[key] = (offset, pixels.shape[0], pixels.shape[1])
+            offset += pixels.nbytes
+
+    with open(f"{output_prefix}.idx", "wb") as f:
+        f.write(orjson.dumps(index))
+
+    return len(index)
+
+
+class PackedImages:
+    """Read-only access to images written by pack_images, backed by a memory-mapped file."""
+
+    def __init__(self, prefix: str) -> None:
+        self._prefix = prefix
+        with open(f"{prefix}.idx", "rb") as f:
+            self._index: Dict[str, Tuple[int, int, int]] = orjson.loads(f.read())
+        self._data: Optional[np.memmap] = None
+
+    def __contains__(self, image_path: str) -> bool:
+        return os.path.normpath(image_path) in self._index
+
+    def __getitem__(self, image_path: str) -> Image.Image:
+        if self._data is None:
+            # Mapped lazily, so that each DataLoader worker gets its own mapping
+            self._data = np.memmap(f"{self._prefix}.bin", dtype=np.uint8, mode="r")
+        offset, height, width = self._index[os.path.normpath(image_path)]
+        pixels = self._data[offset : offset + height * width * 3].reshape(height, width, 3)
+        return Image.fromarray(np.array(pixels))
+
+    def __getstate__(self) -> Dict[str, Any]:
+        return {**self.__dict__, "_data": None}
@@ -1,8 +1,12 @@
 import hashlib
+import multiprocessing
 import os
 from contextlib import AbstractContextManager
 from functools import wraps
-from typing import List
+from typing import Callable, Iterable, Iterator, List, Optional, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
 
 
 def compute_md5_hash_from_bytes(input_bytes: bytes) -> str:
@@ -38,6 +42,30 @@ def singleton(orig_cls):
             cls.__init__(instance, *args, **kwargs)
         return instance
 
+    def clear_instance():
+        # Drops the cached instance (e.g. to free the memory held by a model), the next call constructs a new one
+        nonlocal instance
+        instance = None
+
     orig_cls.__new__ = __new__
+    orig_cls.clear_instance = staticmethod(clear_instance)
 
     return orig_cls
+
+
+def parallel_imap(
+    func: Callable[[T], R],
+    items: Iterable[T],
+    num_workers: int = 1,
+    initializer: Optional[Callable[[], object]] = None,
+    chunksize: int = 32,
+) -> Iterator[R]:
+    """Lazily map a (picklable) function over items with a pool of worker processes, preserving the order of items."""
+    if num_workers <= 1:
+        if initializer is not None:
+            initializer()
+        yield from map(func, items)
+        return
+
+    with multiprocessing.Pool(num_workers, initializer=initializer) as pool:
+        yield from pool.imap(func, items, chunksize=chunksize)
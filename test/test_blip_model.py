@@ -31,6 +31,24 @@ def test_blip_large() -> None:
         print(caption)
 
 
+def test_blip_batch() -> None:
+    engine = BLIPBase(device="cuda:1")  # Load using the default parameters
+
+    # Load two different images
+    image = Image.open("coco_test_images/COCO_val2014_000000165547.jpg").convert("RGB")
+    images = [image, image.transpose(Image.FLIP_TOP_BOTTOM)]
+
+    # Generate captions for both images in a single batch
+    captions = engine.batch(images, n_captions=5, temperature=1.0)
+
+    # There should be one list of captions per image, starting with the image's own baseline caption
+    assert len(captions) == len(images)
+    for image_captions, img in zip(captions, images):
+        assert len(image_captions) == 5  # noqa: PLR2004
+        assert image_captions[0] == engine.get_baseline_caption(img)
+
+
 if __name__ == "__main__":
     test_blip_base()
     test_blip_large()
+    test_blip_batch()
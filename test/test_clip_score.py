@@ -0,0 +1,77 @@
+import os
+import tempfile
+from typing import Any, List, Tuple
+
+import numpy as np
+import torch
+from PIL import Image
+
+from cbc.metrics import clip_score
+
+TEST_IMAGE = os.path.join(os.path.dirname(__file__), "test_image.jpg")
+
+
+class _StubCLIP(torch.nn.Module):
+    # A tiny stand-in for the CLIP model, so that the feature/rank plumbing can be tested on the CPU
+    def __init__(self) -> None:
+        super().__init__()
+        torch.manual_seed(0)
+        self.image_projection = torch.nn.Linear(3 * 4 * 4, 8)
+        self.text_embedding = torch.nn.Embedding(256, 8)
+
+    def encode_image(self, images: torch.Tensor) -> torch.Tensor:
+        return self.image_projection(images.flatten(1))
+
+    def encode_text(self, text: torch.Tensor) -> torch.Tensor:
+        return self.text_embedding(text).sum(dim=1)
+
+
+def _preprocess(image: Image.Image) -> torch.Tensor:
+    pixels = np.asarray(image.convert("RGB").resize((4, 4)), dtype=np.float32) / 255
+    return torch.from_numpy(pixels).permute(2, 0, 1)
+
+
+def _tokenize(texts: List[str]) -> torch.Tensor:
+    return torch.tensor([[ord(c) % 256 for c in text[:16].ljust(16)] for text in texts])
+
+
+def _stub_clip_model() -> Tuple[Any, Any, Any, str]:
+    return _StubCLIP(), _preprocess, _tokenize, "cpu"
+
+
+def test_clip_recall_stub_model() -> None:
+    clip_model = clip_score.clip_model
+    clip_score.clip_model = _stub_clip_model
+    try:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            flipped_image = os.path.join(tmpdir, "flipped.jpg")
+            Image.open(TEST_IMAGE).transpose(Image.FLIP_TOP_BOTTOM).save(flipped_image)
+            samples = [
+                {"image_path": TEST_IMAGE, "candidate_summary": "A cat.", "reference_summary": "A cat on a mat."},
+                {
+                    "image_path": flipped_image,
+                    "candidate_summary": "A dog.",
+                    "reference_summary": "An upside down cat.",
+                },
+            ]
+
+            feature_cache: clip_score.ImageFeatureCache = {}
+            feature_db = clip_score._get_image_feature_db(samples, "image_path", feature_cache=feature_cache)
+            assert feature_db.shape == (2, 8)
+            assert torch.allclose(feature_db.norm(dim=-1), torch.ones(2))
+            assert len(feature_cache) == 2
+
+            ranks = clip_score._compute_ranks([0, 1], feature_db, [s["candidate_summary"] for s in samples])
+            assert ranks.shape == (2,)
+            assert all(1 <= rank <= 2 for rank in ranks)
+
+            samples = clip_score.compute_and_add_clip_recall(
+                [{**s, "scores": {}} for s in samples], "image_path", feature_cache=feature_cache
+            )
+            assert samples[0]["scores"]["candidate_summary_clip_recall_rank"] == float(ranks[0])
+    finally:
+        clip_score.clip_model = clip_model
+
+
+if __name__ == "__main__":
+    test_clip_recall_stub_model()
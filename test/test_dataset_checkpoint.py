@@ -0,0 +1,96 @@
+import os
+import tempfile
+
+from cbc.dataset import _append_jsonl, _load_jsonl, _merge_shard_checkpoints, _rewrite_jsonl
+
+HEADER = {"dataset": "/data/test_dataset.json", "num_samples": 4}
+
+
+def _samples() -> list:
+    return [{"references": [f"A caption of image {i}."], "candidates": [f"Candidate {i}."]} for i in range(4)]
+
+
+def test_checkpoint_round_trip() -> None:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        checkpoint_path = os.path.join(tmpdir, "output.json.tmp.jsonl")
+        samples = _samples()
+        _append_jsonl(checkpoint_path, HEADER, samples, [0, 2])
+        samples[2]["candidate_summary"] = "A summary."
+        _append_jsonl(checkpoint_path, HEADER, samples, [2])
+
+        loaded = [{} for _ in range(4)]
+        assert _load_jsonl(checkpoint_path, HEADER, loaded) == [0, 2]
+        assert loaded == [samples[0], {}, samples[2], {}]
+
+
+def test_checkpoint_truncated_last_line() -> None:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        checkpoint_path = os.path.join(tmpdir, "output.json.tmp.jsonl")
+        samples = _samples()
+        _append_jsonl(checkpoint_path, HEADER, samples, [0, 1])
+        with open(checkpoint_path, "ab") as f:
+            f.write(b'{"index": 2, "sample": {"refer')
+
+        loaded = [{} for _ in range(4)]
+        assert _load_jsonl(checkpoint_path, HEADER, loaded) == [0, 1]
+
+        # The cut off line is dropped, so appending after a resume still gives a readable checkpoint
+        _append_jsonl(checkpoint_path, HEADER, samples, [3])
+        loaded = [{} for _ in range(4)]
+        assert _load_jsonl(checkpoint_path, HEADER, loaded) == [0, 1, 3]
+        assert loaded[3] == samples[3]
+
+
+def test_checkpoint_other_dataset() -> None:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        checkpoint_path = os.path.join(tmpdir, "output.json.tmp.jsonl")
+        _append_jsonl(checkpoint_path, HEADER, _samples(), [0])
+        try:
+            _load_jsonl(checkpoint_path, {**HEADER, "num_samples": 5}, [{} for _ in range(5)])
+        except ValueError:
+            pass
+        else:
+            raise AssertionError("Loaded a checkpoint written for a different dataset")
+
+
+def test_checkpoint_rewrite() -> None:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        checkpoint_path = os.path.join(tmpdir, "output.json.tmp.jsonl")
+        samples = _samples()
+        _append_jsonl(checkpoint_path, HEADER, samples, range(4))
+        _rewrite_jsonl(checkpoint_path, HEADER, samples)
+        _rewrite_jsonl(checkpoint_path, HEADER, samples)
+
+        # The header, and a single line per sample
+        with open(checkpoint_path, "rb") as f:
+            assert len(f.readlines()) == 5
+        loaded = [{} for _ in range(4)]
+        assert _load_jsonl(checkpoint_path, HEADER, loaded) == [0, 1, 2, 3]
+        assert loaded == samples
+
+
+def test_merge_shard_checkpoints() -> None:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        checkpoint_path = os.path.join(tmpdir, "output.json.tmp.jsonl")
+        samples = _samples()
+        _append_jsonl(checkpoint_path, HEADER, samples, [0])
+        _append_jsonl(f"{checkpoint_path}.0", HEADER, samples, [1])
+        _append_jsonl(f"{checkpoint_path}.1", HEADER, samples, [2, 3])
+
+        merged = [{} for _ in range(4)]
+        _merge_shard_checkpoints(checkpoint_path, HEADER, merged)
+        assert merged == [{}, samples[1], samples[2], samples[3]]
+        assert sorted(os.listdir(tmpdir)) == ["output.json.tmp.jsonl"]
+
+        # The shards are folded into the main checkpoint
+        loaded = [{} for _ in range(4)]
+        assert _load_jsonl(checkpoint_path, HEADER, loaded) == [0, 1, 2, 3]
+        assert loaded == samples
+
+
+if __name__ == "__main__":
+    test_checkpoint_round_trip()
+    test_checkpoint_truncated_last_line()
+    test_checkpoint_other_dataset()
+    test_checkpoint_rewrite()
+    test_merge_shard_checkpoints()
@@ -0,0 +1,21 @@
+import os
+
+from transformers import LlamaTokenizer
+
+from cbc.caption.ic3.caption_by_committee import DEFAULT_CBC_PROMPT, get_prompt_for_candidates
+from cbc.lm.huggingface_llama_engine import _tokenize_continuations
+
+
+def test_tokenize_continuations() -> None:
+    tokenizer = LlamaTokenizer.from_pretrained(f"{os.environ.get('HUGGINGFACE_LLAMA_WEIGHTS_ROOT', '')}7B")
+    candidates = ["A dog runs on the beach.", "A brown dog running along the shore."]
+    prefix = DEFAULT_CBC_PROMPT.partition("{")[0]
+    for plugin_outputs in ([], [{"prompt_body": "Also, use the tags.", "image_info": "Tags: dog, beach"}]):
+        prompt = get_prompt_for_candidates(candidates, plugin_outputs=plugin_outputs)
+        assert prompt.startswith(prefix)
+        suffix_ids = _tokenize_continuations(tokenizer, [prompt[len(prefix) :]])[0]
+        assert tokenizer(prefix).input_ids + suffix_ids == tokenizer(prompt).input_ids
+
+
+if __name__ == "__main__":
+    test_tokenize_continuations()
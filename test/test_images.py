@@ -0,0 +1,33 @@
+import os
+import pickle
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+from cbc.utils.images import PackedImages, pack_images
+
+TEST_IMAGE = os.path.join(os.path.dirname(__file__), "test_image.jpg")
+
+
+def test_packed_images() -> None:
+    with tempfile.TemporaryDirectory() as tmpdir:
+        prefix = os.path.join(tmpdir, "images")
+        # Duplicates (after normalizing the path) are only packed once
+        assert pack_images([TEST_IMAGE, os.path.join(os.path.dirname(TEST_IMAGE), ".", "test_image.jpg")], prefix) == 1
+
+        store = PackedImages(prefix)
+        assert TEST_IMAGE in store
+        assert os.path.join(tmpdir, "missing.jpg") not in store
+
+        expected = np.asarray(Image.open(TEST_IMAGE).convert("RGB"))
+        assert np.array_equal(np.asarray(store[TEST_IMAGE]), expected)
+
+        # The store is sent to the DataLoader workers, both before and after it has mapped the file
+        for copy in (pickle.loads(pickle.dumps(store)), pickle.loads(pickle.dumps(PackedImages(prefix)))):
+            assert TEST_IMAGE in copy
+            assert np.array_equal(np.asarray(copy[TEST_IMAGE]), expected)
+
+
+if __name__ == "__main__":
+    test_packed_images()